@@ -0,0 +1,310 @@
+""" Benchmarks for the processing chain on synthetic data.
+    Synthetic R31 logs (with GPGGA records split over two lines), GPX tracks, GPS tracker tracks, and calibration
+    files are generated for every size. For every stage the wall time, throughput (rows per second), and
+    peak memory (traced Python and numpy allocations) are recorded, scaling with the size is estimated as the
+    slope of log(time) over log(size).
+    Results can be saved as a baseline and compared with a later run to detect regressions.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from estimate_thickness import Calibration, estimate_height
+from gps_drift import align_tracks, estimate_drift, interpolate_tracks
+from read_gpx import read_gpx
+from read_r31 import read_r31
+
+
+SIZES = [1000, 10000, 100000]
+CHUNK_SIZE = 100000
+
+
+def make_r31(out_file, n_samples, samples_per_fix=5, start_seconds=36000, seed=0):
+    """ Write a synthetic R31 log with *n_samples* EM measurements and a GPS fix (1 Hz) before every
+        *samples_per_fix* measurements. GPGGA records are split over two lines as in the EM-31 logs,
+        at a position varying from record to record.
+    """
+    rng = np.random.RandomState(seed)
+    with open(out_file, 'w') as f:
+        f.write('E31 synthetic log\n')
+        for start in range(0, n_samples, CHUNK_SIZE):
+            n = min(CHUNK_SIZE, n_samples - start)
+            values = rng.randint(100, 999, n)
+            split = rng.randint(1, 8, n)
+            lines = []
+            for i in range(n):
+                k = start + i
+                if k % samples_per_fix == 0:
+                    fix = k // samples_per_fix
+                    seconds = (start_seconds + fix) % 86400
+                    lat = '{0:09.4f}'.format(7712.3456 + fix * 3e-4)
+                    lines.append('@$GPGGA,{0:02d}{1:02d}{2:02d}.00,{3}\n'.format(seconds // 3600, seconds // 60 % 60, seconds % 60, lat[:split[i]]))
+                    lines.append('@{0},N,{1:010.4f},E,1,08,0.9,10.0,M,,,,*47\n'.format(lat[split[i]:], 3412.5678 + fix * 5e-4))
+                lines.append('T data:-{0:04d}+{1:04d}\n'.format(values[i], k % 100))
+            f.write(''.join(lines))
+
+
+def make_gpx(out_file, n_points, n_tracks=1, n_segments=1, start_time='2019-04-22T00:00:00'):
+    """ Write a synthetic .gpx file with *n_points* track points at 1 Hz,
+        split into *n_tracks* tracks with *n_segments* segments each.
+    """
+    n_parts = n_tracks * n_segments
+    bounds = np.linspace(0, n_points, n_parts + 1).astype(int)
+    start = pd.Timestamp(start_time)
+    with open(out_file, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" creator="benchmark">\n')
+        f.write('<metadata><time>{0}</time></metadata>\n'.format(start.strftime('%Y-%m-%dT%H:%M:%SZ')))
+        for part in range(n_parts):
+            if part % n_segments == 0:
+                f.write('<trk><name>Track {0}</name>\n'.format(part // n_segments))
+            f.write('<trkseg>\n')
+            """ Points are written in chunks, so the memory use does not grow with the file size. """
+            for chunk in range(bounds[part], bounds[part + 1], CHUNK_SIZE):
+                index = np.arange(chunk, min(chunk + CHUNK_SIZE, bounds[part + 1]))
+                times = (start + pd.to_timedelta(index, unit='s')).strftime('%Y-%m-%dT%H:%M:%SZ')
+                f.write(''.join('<trkpt lat="{0:.7f}" lon="{1:.7f}"><ele>{2:.1f}</ele><time>{3}</time></trkpt>\n'.format(
+                    80. + (i + 1) * 1e-6, 30. + (i + 1) * 2e-6, i % 10, t) for i, t in zip(index, times)))
+            f.write('</trkseg>\n')
+            if part % n_segments == n_segments - 1:
+                f.write('</trk>\n')
+        f.write('</gpx>\n')
+
+
+def make_tracks(n_points, n_trackers=1, start_time='2019-04-22T00:00:00', seed=0):
+    """ Synthetic 1 Hz tracks of GPS trackers on a drifting ice floe.
+        Returns a list of pandas DataFrames with lat, lon, and time columns.
+    """
+    rng = np.random.RandomState(seed)
+    time = pd.date_range(start=start_time, periods=n_points, freq='1s')
+    drift_lat = 80. + np.cumsum(rng.normal(1e-6, 2e-7, n_points))
+    drift_lon = 30. + np.cumsum(rng.normal(2e-6, 4e-7, n_points))
+    tracks = []
+    for i in range(n_trackers):
+        tracks.append(pd.DataFrame({'lat': drift_lat + i * 5e-4 + rng.normal(0, 2e-6, n_points),
+                                    'lon': drift_lon + rng.normal(0, 5e-6, n_points),
+                                    'time': time}))
+    return tracks
+
+
+def make_calibration_csv(out_file, n_points=15, ice_thickness=71., seed=0):
+    """ Write a synthetic calibration file: EM values measured with the device lifted to *n_points* heights
+        above the ice of *ice_thickness* (the same units as the heights).
+    """
+    rng = np.random.RandomState(seed)
+    height = np.linspace(10, 230, n_points)
+    value = 980. * np.exp(-(height + ice_thickness) / 131.) * rng.normal(1., 0.01, n_points)
+    thickness = ice_thickness + rng.normal(0, 1., n_points)
+    pd.DataFrame({'height': height, 'value': value, 'ice_thickness': thickness}).to_csv(out_file, index=False)
+
+
+def legacy_estimate_drift(gps_data):
+    """ Previous implementation of gps_drift.estimate_drift, kept for comparison. """
+    R = 6400000
+    d_lat = gps_data['lat'].diff()
+    d_lon = gps_data['lon'].diff()
+    d_angle = np.arccos(np.sin(gps_data['lon']) * np.sin(gps_data['lon'].shift(1)) + np.cos(gps_data['lon']) * np.cos(gps_data['lon'].shift(1)) * np.cos(gps_data['lat'].diff()))
+    d_lat_meters = d_lat / 180. * np.pi * R
+    d_lon_meters = d_lon / 180. * np.pi * R * np.cos(gps_data['lat'])
+    d_abs_meters = (d_lat_meters**2 + d_lon_meters**2)**0.5
+    d_time = gps_data['time'].diff()
+    d_time_sec = pd.Series([i.seconds for i in d_time])
+    d_rate = d_abs_meters / d_time_sec
+
+    drift = pd.DataFrame()
+    drift['d_lat'] = d_lat
+    drift['d_lon'] = d_lon
+    drift['drift_meters'] = d_abs_meters
+    drift['drift_rate'] = d_rate
+    drift['d_time_sec'] = d_time_sec
+    drift['d_angle'] = d_angle
+    drift['time'] = gps_data['time']
+    return drift
+
+
+""" Stages: every function prepares the input of size *n* in *tmp_dir* (not timed)
+    and returns the function to be timed.
+"""
+
+
+def _stage_read_r31(n, tmp_dir):
+    r31_file = os.path.join(tmp_dir, 'survey.R31')
+    make_r31(r31_file, n)
+    return lambda: read_r31(r31_file, '20190422')
+
+
+def _stage_read_gpx(n, tmp_dir):
+    gpx_file = os.path.join(tmp_dir, 'track.gpx')
+    make_gpx(gpx_file, n, 2, 2)
+    return lambda: read_gpx(gpx_file)
+
+
+def _stage_interpolate_tracks(n, tmp_dir):
+    track_files = []
+    for i, track in enumerate(make_tracks(n, 3)):
+        track_files.append(os.path.join(tmp_dir, 'track_{0}.csv'.format(i)))
+        track.assign(time=track.time.dt.strftime('%Y-%m-%dT%H:%M:%SZ')).to_csv(track_files[-1], index=False)
+    return lambda: interpolate_tracks(track_files)
+
+
+def _stage_align_tracks(n, tmp_dir):
+    tracks = make_tracks(n, 3)
+    times = tracks[0].time.values + np.timedelta64(300, 'ms')
+    return lambda: align_tracks(tracks, times)
+
+
+def _stage_estimate_drift(n, tmp_dir):
+    tracks = make_tracks(n, 3)
+    return lambda: estimate_drift(tracks)
+
+
+def _stage_estimate_drift_previous(n, tmp_dir):
+    tracks = make_tracks(n, 3)
+    return lambda: [legacy_estimate_drift(track) for track in tracks]
+
+
+def _stage_estimate_height(n, tmp_dir):
+    calibration_file = os.path.join(tmp_dir, 'calibration.csv')
+    make_calibration_csv(calibration_file)
+    calibration = Calibration.from_csv(calibration_file)
+    df = pd.DataFrame({'data': np.random.RandomState(0).uniform(150, 900, n)})
+    return lambda: estimate_height(df, calibration, 35.)
+
+
+def _stage_estimate_height_sigma(n, tmp_dir):
+    calibration_file = os.path.join(tmp_dir, 'calibration.csv')
+    make_calibration_csv(calibration_file)
+    calibration = Calibration.from_csv(calibration_file)
+    random = np.random.RandomState(0)
+    df = pd.DataFrame({'data': random.uniform(150, 900, n),
+                       'lat_corr': 80. + np.cumsum(random.normal(0, 1e-5, n)),
+                       'lon_corr': 10. + np.cumsum(random.normal(0, 5e-5, n))})
+    return lambda: estimate_height(df, calibration, 35., 'linear')
+
+
+STAGES = {'read_r31': _stage_read_r31,
+          'read_gpx': _stage_read_gpx,
+          'interpolate_tracks': _stage_interpolate_tracks,
+          'align_tracks': _stage_align_tracks,
+          'estimate_drift': _stage_estimate_drift,
+          'estimate_drift_previous': _stage_estimate_drift_previous,
+          'estimate_height': _stage_estimate_height,
+          'estimate_height_sigma': _stage_estimate_height_sigma,
+          }
+
+
+def run_stage(stage, n, repeat=3, memory=True):
+    """ Benchmark one stage on *n* rows of synthetic data.
+        Returns a dictionary with the best wall time of *repeat* runs (seconds), rows per second,
+        and peak traced memory in MB (measured in a separate run, since tracing slows the code down).
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        func = STAGES[stage](n, tmp_dir)
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            seconds.append(time.perf_counter() - start)
+        peak = None
+        if memory:
+            tracemalloc.start()
+            func()
+            peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+    best = min(seconds)
+    return {'stage': stage, 'n': n, 'seconds': best, 'rows_per_second': n / best, 'peak_mb': peak}
+
+
+def scaling(results):
+    """ Slope of log(time) over log(size) for every stage with more than one size: 1 means linear scaling. """
+    slopes = {}
+    for stage in sorted(set(item['stage'] for item in results)):
+        items = [item for item in results if item['stage'] == stage]
+        if len(items) > 1:
+            slopes[stage] = float(np.polyfit(np.log([item['n'] for item in items]),
+                                             np.log([item['seconds'] for item in items]), 1)[0])
+    return slopes
+
+
+def compare(results, baseline, tolerance=0.25):
+    """ List of regressions: stages and sizes with throughput lower or peak memory higher than in the *baseline*
+        by more than *tolerance* (relative). Stages and sizes missing in the baseline are skipped.
+    """
+    reference = {(item['stage'], item['n']): item for item in baseline['results']}
+    regressions = []
+    for item in results:
+        base = reference.get((item['stage'], item['n']))
+        if base is None:
+            continue
+        if item['rows_per_second'] < base['rows_per_second'] * (1 - tolerance):
+            regressions.append('{0} n={1}: {2:.0f} rows/s, baseline {3:.0f} rows/s'.format(
+                item['stage'], item['n'], item['rows_per_second'], base['rows_per_second']))
+        """ 1 MB margin for small sizes where the peak is dominated by constant overhead. """
+        if item['peak_mb'] is not None and base['peak_mb'] is not None and item['peak_mb'] > base['peak_mb'] * (1 + tolerance) + 1:
+            regressions.append('{0} n={1}: {2:.1f} MB peak, baseline {3:.1f} MB'.format(
+                item['stage'], item['n'], item['peak_mb'], base['peak_mb']))
+    return regressions
+
+
+if __name__ == '__main__':
+    desc = """ Run benchmarks of the processing stages on synthetic data.
+               Arguments:
+               -stages      comma separated list of stages (optional), default is all:
+                            {0}
+               -sizes       comma separated list of sizes, e.g. 1e3,1e5,1e7 (optional), default is {1}
+               -repeat      number of timed runs, the best one is reported (optional), default is 3
+               -nomemory    if specified, peak memory is not measured
+               -save        json file to save the results to (to be used as a baseline)
+               -compare     baseline json file to compare the results with, exit code is 1 if there are regressions
+               -tolerance   relative tolerance of the comparison (optional), default is 0.25
+           """.format(', '.join(STAGES), ','.join(str(item) for item in SIZES))
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('-stages', help='Stages to run.')
+    parser.add_argument('-sizes', help='Sizes (number of rows).')
+    parser.add_argument('-repeat', help='Number of timed runs.')
+    parser.add_argument('-nomemory', action='store_true', help='Do not measure peak memory.')
+    parser.add_argument('-save', help='Json file to save the results to.')
+    parser.add_argument('-compare', help='Baseline json file.')
+    parser.add_argument('-tolerance', help='Relative tolerance of the comparison.')
+    args = parser.parse_args()
+
+    stages = args.stages.split(',') if args.stages else list(STAGES)
+    for stage in stages:
+        if stage not in STAGES:
+            print('Unknown stage {0}, possible values are: {1}.'.format(stage, ', '.join(STAGES)))
+            sys.exit()
+    sizes = [int(float(item)) for item in args.sizes.split(',')] if args.sizes else SIZES
+    repeat = int(args.repeat) if args.repeat else 3
+
+    results = []
+    print('{0:<25}{1:>10}{2:>12}{3:>14}{4:>10}'.format('stage', 'n', 'seconds', 'rows/s', 'peak MB'))
+    for stage in stages:
+        for n in sizes:
+            item = run_stage(stage, n, repeat, not args.nomemory)
+            results.append(item)
+            peak = '' if item['peak_mb'] is None else '{0:.1f}'.format(item['peak_mb'])
+            print('{0:<25}{1:>10}{2:>12.4f}{3:>14.0f}{4:>10}'.format(stage, n, item['seconds'], item['rows_per_second'], peak))
+    slopes = scaling(results)
+    for stage, slope in slopes.items():
+        print('{0}: time ~ n^{1:.2f}'.format(stage, slope))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'results': results, 'scaling': slopes}, f, indent=2)
+        print('Results are saved to {0}.'.format(args.save))
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, float(args.tolerance) if args.tolerance else 0.25)
+        for item in regressions:
+            print('Regression: {0}'.format(item))
+        if regressions:
+            sys.exit(1)
+        print('No regressions compared to {0}.'.format(args.compare))
@@ -1,57 +1,258 @@
 """ Some tools for observations on a floating ice.
 """
+import numpy as np
 import pandas as pd
 
+from gps_drift import fit_rigid_transforms, from_local_xy, to_local_xy
+
+
+class ReferenceSeries(object):
+    """ Time series of GPS fixes (time, lat, lon) of a reference point, optimized for appending.
+        Fixes are stored in preallocated numpy buffers that grow geometrically, so appending is amortized O(1)
+        per fix. The series is kept sorted by time: fixes arriving in order are written at the end,
+        late fixes are merged into place.
+    """
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self._time = np.empty(capacity, dtype=np.int64)
+        self._lat = np.empty(capacity, dtype=float)
+        self._lon = np.empty(capacity, dtype=float)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def time(self):
+        return self._time[:self.size].view('datetime64[ns]')
+
+    @property
+    def lat(self):
+        return self._lat[:self.size]
+
+    @property
+    def lon(self):
+        return self._lon[:self.size]
+
+    def append(self, time, lat, lon):
+        """ Append one or many fixes, *time* is a datetime64 value or array. """
+        if np.ndim(time) == 0:
+            """ Fast path for a single fix arriving in order. """
+            t = np.datetime64(time, 'ns').astype(np.int64)
+            if not self.size or t >= self._time[self.size - 1]:
+                if self.size == self._time.size:
+                    self._grow(self.size + 1)
+                self._time[self.size] = t
+                self._lat[self.size] = lat
+                self._lon[self.size] = lon
+                self.size += 1
+                return
+        time = np.atleast_1d(np.asarray(time, dtype='datetime64[ns]')).astype(np.int64)
+        lat = np.atleast_1d(np.asarray(lat, dtype=float))
+        lon = np.atleast_1d(np.asarray(lon, dtype=float))
+        n = time.size
+        if not n:
+            return
+        if self.size + n > self._time.size:
+            self._grow(self.size + n)
+        if np.any(time[1:] < time[:-1]):
+            order = np.argsort(time, kind='stable')
+            time, lat, lon = time[order], lat[order], lon[order]
+        start = self.size
+        self._time[start:start + n] = time
+        self._lat[start:start + n] = lat
+        self._lon[start:start + n] = lon
+        self.size += n
+        if start and time[0] < self._time[start - 1]:
+            """ Late fixes: only the stored fixes later than the first new one are merged with them,
+                so the cost depends on how late the fixes are, not on the length of the series.
+            """
+            position = np.searchsorted(self._time[:start], time[0], side='right')
+            order = np.argsort(self._time[position:self.size], kind='stable') + position
+            self._time[position:self.size] = self._time[order]
+            self._lat[position:self.size] = self._lat[order]
+            self._lon[position:self.size] = self._lon[order]
+
+    def _grow(self, size):
+        capacity = max(size, 2 * self._time.size)
+        for name in ['_time', '_lat', '_lon']:
+            buffer = getattr(self, name)
+            new = np.empty(capacity, dtype=buffer.dtype)
+            new[:self.size] = buffer[:self.size]
+            setattr(self, name, new)
+
+    def interpolate(self, time):
+        """ Coordinates (lat, lon arrays) at the given time(s), NaN outside of the series.
+            np.interp finds the neighbouring fixes with binary search.
+        """
+        query = np.atleast_1d(np.asarray(time, dtype='datetime64[ns]')).astype(np.int64)
+        t = self._time[:self.size]
+        return (np.interp(query, t, self._lat[:self.size], left=np.nan, right=np.nan),
+                np.interp(query, t, self._lon[:self.size], left=np.nan, right=np.nan))
+
+    def to_frame(self):
+        """ pandas DataFrame with lat, lon, and time columns (copy of the data). """
+        return pd.DataFrame({'lat': self.lat.copy(), 'lon': self.lon.copy(), 'time': self.time.copy()})
+
 
 class IceFloe(object):
     """ Basic class for an ice floe.
+        The floe-fixed coordinate system has its origin at the zero point and the x axis directed to the unit point,
+        coordinates are in metres. Positions of the reference points (GPS trackers) are used to find
+        the rotation and translation of the floe at any time.
     """
     def __init__(self, name, heading, desc=''):
         self.name = name
         self.desc = desc
         self.heading = heading
-        """ Zero point is a pandas dataframe with gps coordinates of the (0, 0) point on the ice floe. """
-        self.zero_point = pd.DataFrame()
-        """ Unit point is a pandas DataFrame with GPS coordinates of the (unit, 0) point on the ice flow.
-            This is the point that defines the direction of the x (or y) axis.
+        """ Reference points are ReferenceSeries with GPS coordinates (lat, lon, time) of points on the ice floe.
+            Zero point is the (0, 0) point on the ice floe.
+            Unit point is the (unit, 0) point on the ice flow. This is the point that defines the direction of the x axis.
+            More points (trackers) can be added with add_reference_point.
         """
-        self.unit_point = pd.DataFrame()
-    
-    def calculate_drift(self, timepoint_1, timepoint_2):
+        self.reference_points = {'zero': ReferenceSeries(), 'unit': ReferenceSeries()}
+        """ Floe-fixed coordinates of the reference points, None if they should be estimated from the GPS data. """
+        self.local_coordinates = {'zero': (0., 0.), 'unit': None}
+
+    @property
+    def zero_point(self):
+        return self.reference_points['zero']
+
+    @property
+    def unit_point(self):
+        return self.reference_points['unit']
+
+    def add_reference_point(self, point_id, x=None, y=None):
+        """ Add a reference point (GPS tracker) with floe-fixed coordinates x, y (metres).
+            If the coordinates are not given, they are estimated from the GPS data with respect to the zero and unit points.
+        """
+        point_id = point_id.lower()
+        if point_id in self.reference_points:
+            print('Reference point {0} already exists.'.format(point_id))
+            return False
+        self.reference_points[point_id] = ReferenceSeries()
+        self.local_coordinates[point_id] = None if x is None or y is None else (float(x), float(y))
         return True
 
+    def calculate_drift(self, timepoint_1, timepoint_2):
+        """ Drift of the floe between two timepoints (scalars or arrays).
+            Returns displacement of the zero point to the east and to the north (metres) and rotation angle (radians,
+            counterclockwise).
+        """
+        transform_1 = self.transform(timepoint_1)
+        transform_2 = self.transform(timepoint_2)
+        if transform_1 is False or transform_2 is False:
+            return False
+        angle_1, translation_1 = transform_1
+        angle_2, translation_2 = transform_2
+        rotation = np.mod(angle_2 - angle_1 + np.pi, 2 * np.pi) - np.pi
+        return translation_2[:, 0] - translation_1[:, 0], translation_2[:, 1] - translation_1[:, 1], rotation
+
     def visualise_rotation(self, timepoint_1, timepoint_2):
         return True
-    
+
     def global2local(self, lat, lon, time):
-        return True
-    
+        """ Convert GPS coordinates observed at the given time(s) into floe-fixed coordinates x, y (metres).
+            All arguments can be arrays of the same length, the conversion is done for all points at once.
+        """
+        transform = self.transform(time)
+        if transform is False:
+            return False
+        angle, translation = transform
+        lat0, lon0 = self.origin()
+        east, north = to_local_xy(lat, lon, lat0, lon0)
+        east = east - translation[:, 0]
+        north = north - translation[:, 1]
+        cos = np.cos(angle)
+        sin = np.sin(angle)
+        return cos * east + sin * north, -sin * east + cos * north
+
     def local2global(self, x, y, time=''):
-        return True
-    
+        """ Convert floe-fixed coordinates x, y (metres) into GPS coordinates at the given time(s).
+            If time is not specified, the time of the last zero point fix is used.
+        """
+        if time is None or (isinstance(time, str) and not time):
+            time = self.zero_point.time[-1:]
+        transform = self.transform(time)
+        if transform is False:
+            return False
+        angle, translation = transform
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        cos = np.cos(angle)
+        sin = np.sin(angle)
+        lat0, lon0 = self.origin()
+        return from_local_xy(cos * x - sin * y + translation[:, 0], sin * x + cos * y + translation[:, 1], lat0, lon0)
+
+    def origin(self):
+        """ Projection origin (lat, lon): the first fix of the zero point. """
+        return self.zero_point.lat[0], self.zero_point.lon[0]
+
+    def transform(self, time, point_ids=None):
+        """ Rotation angles (radians) and translations (metres east and north of the projection origin)
+            of the floe at the given time(s). The transform maps floe-fixed coordinates to projected coordinates.
+            Reference point positions are interpolated to the given times and the rigid transform is fitted
+            with least squares for all timepoints at once.
+        """
+        if not len(self.zero_point):
+            print('GPS data for the zero point is required.')
+            return False
+        time = np.atleast_1d(np.asarray(time, dtype='datetime64[ns]'))
+        if point_ids is None:
+            point_ids = [point_id for point_id, series in self.reference_points.items() if len(series)]
+        lat0, lon0 = self.origin()
+        local = np.array([self._local_coordinates(point_id) for point_id in point_ids])
+        observed = np.empty((time.size, len(point_ids), 2))
+        for k, point_id in enumerate(point_ids):
+            lat, lon = self.reference_points[point_id].interpolate(time)
+            observed[:, k, 0], observed[:, k, 1] = to_local_xy(lat, lon, lat0, lon0)
+        return fit_rigid_transforms(local, observed)
+
+    def _local_coordinates(self, point_id):
+        """ Floe-fixed coordinates of a reference point, estimated from the GPS data if not known. """
+        if self.local_coordinates[point_id] is not None:
+            return self.local_coordinates[point_id]
+        series = self.reference_points[point_id]
+        lat0, lon0 = self.origin()
+        if point_id == 'unit':
+            """ The unit point lies on the x axis at the median distance from the zero point. """
+            lat, lon = self.zero_point.interpolate(series.time)
+            x0, y0 = to_local_xy(lat, lon, lat0, lon0)
+            x1, y1 = to_local_xy(series.lat, series.lon, lat0, lon0)
+            coordinates = (float(np.nanmedian(np.hypot(x1 - x0, y1 - y0))), 0.)
+        else:
+            point_ids = [item for item in ['zero', 'unit'] if len(self.reference_points[item])]
+            angle, translation = self.transform(series.time, point_ids)
+            x, y = to_local_xy(series.lat, series.lon, lat0, lon0)
+            x = x - translation[:, 0]
+            y = y - translation[:, 1]
+            coordinates = (float(np.nanmedian(np.cos(angle) * x + np.sin(angle) * y)),
+                           float(np.nanmedian(-np.sin(angle) * x + np.cos(angle) * y)))
+        self.local_coordinates[point_id] = coordinates
+        return coordinates
+
     def extend_reference_point_serie(self, point_id, data):
-        """ Extend the time and coordinates (lat, lon) of the zero point.
+        """ Extend the time and coordinates (lat, lon) of a reference point.
             Data is expected to be a pandas DataFrame with the following columns:
             lat, lon, time (UTC)
-            point_id can be either 'zero' or 'unit'
+            point_id can be either 'zero', 'unit', or an id of a point added with add_reference_point.
         """
         if 'lat' not in data.columns or 'lon' not in data.columns or 'time' not in data.columns:
             print('Input data is expected to contain the following columns: "lat", "lon", "time".')
             print('The input data has the following columns: {0}'.format(data.columns))
             return False
-        if data.shape[1] >= 3:
-            data_new = data.filter(items=['lat', 'lon', 'time'])
-        else:
-            data_new = data
-        if point_id.lower() == 'zero':
-            self.zero_point = pd.concat([self.zero_point, data_new], ignore_index=True)
-        elif point_id.lower() == 'unit':
-            self.unit_point = pd.concat([self.unit_point, data_new], ignore_index=True)
-        else:
-            print('Wrong point_id. Possible values are "zero", "unit". Given value is {0}'.format(point_id))
+        return self.add_fixes(point_id, data['time'].values, data['lat'].values, data['lon'].values)
+
+    def add_fixes(self, point_id, time, lat, lon):
+        """ Append one or many GPS fixes of a reference point, amortized O(1) per fix.
+            This is the entry point for streams of fixes from a drift station.
+        """
+        point_id = point_id.lower()
+        if point_id not in self.reference_points:
+            print('Wrong point_id. Possible values are {0}. Given value is {1}'.format(', '.join('"{0}"'.format(item) for item in self.reference_points), point_id))
             return False
+        self.reference_points[point_id].append(time, lat, lon)
         return True
-    
+
 
 if __name__ == '__main__':
     pass
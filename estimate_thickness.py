@@ -1,20 +1,254 @@
 """ Estimate sea ice and snow thickness from EM-31 measurements
+    Uncertainty of the thickness can be estimated alongside: linear propagation of the calibration fit covariance
+    combined with the position error (GPS and drift correction), or Monte Carlo resampling of the calibration.
 """
 import argparse
+import hashlib
 import sys
 
 import numpy as np
 import pandas as pd
 
+from gps_drift import to_local_xy
+from profiling import DEFAULT_REPORT, enable as enable_profiling, profiled
+from survey_cache import cached_read
+from survey_io import read_table, write_table
 
-def estimate_height(df, calibration_csv, em_height):
+
+""" Calibrations are memoized by the content of the calibration file and the fit parameters. """
+_calibrations = {}
+""" Typical position error of a handheld GPS receiver, m. """
+GPS_ERROR = 3.
+
+
+class Calibration(object):
+    """ Fit of the distance between the EM device and the water-ice interface
+        as a function of the logarithm of the EM value.
+        *kind* is one of the following:
+            'log'        linear function of log(value), the default;
+            'poly'       polynomial of log(value) of the given *degree*;
+            'piecewise'  continuous piecewise linear function of log(value) with nodes at the *breakpoints* (EM values).
+        Only the coefficients are needed to apply the calibration, so the object is cheap to pickle
+        and send to worker processes.
+        Uncertainty of the fit is kept as well: covariance of the coefficients, variance of the calibration points
+        around the fit, and variance of the average ice thickness (used as an offset of all the distances).
+    """
+    def __init__(self, height, value, ice_thickness, kind='log', degree=1, breakpoints=None):
+        height = np.asarray(height, dtype=float)
+        value = np.asarray(value, dtype=float)
+        valid = ~(np.isnan(height) | np.isnan(value))
+        self.height = height[valid]
+        self.value = value[valid]
+        ice_thickness = np.asarray(ice_thickness, dtype=float)
+        self.ice_thickness = ice_thickness[~np.isnan(ice_thickness)]
+        self.average_ice_thickness = float(np.nanmean(ice_thickness))
+        self.kind = kind
+        self.degree = 1 if kind == 'log' else degree
+        if kind == 'log':
+            self.coefficients, covariance = self._polyfit(np.log(self.value), self.height + self.average_ice_thickness, 1)
+            self.knots = np.array([])
+        elif kind == 'poly':
+            self.coefficients, covariance = self._polyfit(np.log(self.value), self.height + self.average_ice_thickness, degree)
+            self.knots = np.array([])
+        elif kind == 'piecewise':
+            self.knots = np.sort(np.log(np.asarray(breakpoints if breakpoints is not None else [], dtype=float)))
+            basis = self._basis(np.log(self.value))
+            self.coefficients = np.linalg.lstsq(basis, self.height + self.average_ice_thickness, rcond=None)[0]
+            covariance = None
+        else:
+            raise ValueError('Unknown calibration kind {0}, possible values are "log", "poly", "piecewise".'.format(kind))
+        self._fit_uncertainty(covariance)
+
+    @staticmethod
+    def _polyfit(x, y, degree):
+        """ Polynomial fit with the covariance of the coefficients (None if there are too few points for it). """
+        if x.size > degree + 1:
+            return np.polyfit(x, y, degree, cov=True)
+        return np.polyfit(x, y, degree), None
+
+    def _fit_uncertainty(self, covariance=None):
+        """ Variance of the calibration points around the fit and covariance of the coefficients.
+            The covariance is computed from the design matrix if it is not given (piecewise fit, few points).
+            With as many coefficients as calibration points the fit uncertainty is unknown (NaN).
+        """
+        design = self._design(np.log(self.value))
+        residuals = self.height + self.average_ice_thickness - design.dot(self.coefficients)
+        dof = self.value.size - design.shape[1]
+        self.residual_variance = float(residuals.dot(residuals) / dof) if dof > 0 else np.nan
+        if covariance is None:
+            covariance = self.residual_variance * np.linalg.pinv(design.T.dot(design))
+        self.covariance = covariance
+        """ A single contact measurement gives no estimate of the spread, the offset uncertainty is neglected then. """
+        n = self.ice_thickness.size
+        self.offset_variance = float(np.var(self.ice_thickness, ddof=1) / n) if n > 1 else 0.
+
+    @classmethod
+    def from_csv(cls, calibration_csv, kind='log', degree=1, breakpoints=None):
+        """ Create a calibration from a *.csv file with the following columns:
+            'height' and 'value' for calibration points, and 'ice_thickness' with some contact measurements of sea ice thickness.
+            The fit is reused if a file with the same content has been fitted with the same parameters before.
+            Returns None if the file could not be read.
+        """
+        try:
+            with open(calibration_csv, 'rb') as f:
+                content = f.read()
+        except (OSError, TypeError):
+            print('Could not read the calibration csv file {0}.'.format(calibration_csv))
+            return None
+        key = (hashlib.sha1(content).hexdigest(), kind, degree, None if breakpoints is None else tuple(breakpoints))
+        if key in _calibrations:
+            return _calibrations[key]
+
+        try:
+            calibration = pd.read_csv(calibration_csv)
+        except:
+            print('Could not read the calibration csv file {0}.'.format(calibration_csv))
+            return None
+        """ Check for the required columns in the calibration data. """
+        if 'height' not in calibration.columns:
+            print("The 'height' column is not found in the calibration csv file.")
+            return None
+        if 'value' not in calibration.columns:
+            print("The 'value' column is not found in the calibration csv file.")
+            return None
+        if 'ice_thickness' not in calibration.columns:
+            print("The 'ice_thicknes' column is not found in the calibration csv file.")
+            return None
+
+        _calibrations[key] = cls(calibration.height, calibration.value, calibration.ice_thickness, kind, degree, breakpoints)
+        return _calibrations[key]
+
+    def _basis(self, x):
+        """ Design matrix of the piecewise linear fit: 1, x, and a hinge function for every knot. """
+        return np.column_stack([np.ones_like(x), x, np.maximum(x[:, None] - self.knots[None, :], 0)])
+
+    def _design(self, x):
+        """ Design matrix of the fit for log(value) *x*, columns are in the order of the coefficients. """
+        if self.kind == 'piecewise':
+            return self._basis(x)
+        return np.vander(x, self.degree + 1)
+
+    def distance(self, values):
+        """ Distance between the EM device and the water-ice interface for an array of EM values. """
+        x = np.log(np.asarray(values, dtype=float))
+        if self.kind == 'piecewise':
+            result = self.coefficients[0] + self.coefficients[1] * x
+            for knot, coefficient in zip(self.knots, self.coefficients[2:]):
+                result += coefficient * np.maximum(x - knot, 0)
+            return result
+        return np.polyval(self.coefficients, x)
+
+    def sigma(self, values):
+        """ Standard deviation of the distance for an array of EM values (linear error propagation):
+            uncertainty of the fitted curve at the value, scatter of the calibration points around the fit,
+            and uncertainty of the average ice thickness.
+        """
+        x = np.log(np.asarray(values, dtype=float))
+        if self.kind == 'piecewise':
+            design = self._design(x)
+            variance = (design.dot(self.covariance) * design).sum(axis=1)
+        else:
+            """ For a polynomial the variance g' C g is a polynomial of twice the degree, its coefficients are
+                the sums of the antidiagonals of the covariance.
+            """
+            flipped = np.fliplr(self.covariance)
+            n = self.degree
+            variance = np.polyval([np.trace(flipped, offset) for offset in range(n, -n - 1, -1)], x)
+        return np.sqrt(variance + self.residual_variance + self.offset_variance)
+
+    def bootstrap(self, n_samples=200, seed=None):
+        """ Coefficients refitted to *n_samples* resamples (with replacement) of the calibration points
+            and contact ice thickness measurements, all the fits are solved at once.
+            Returns an array of shape (n_samples, number of coefficients).
+        """
+        rng = np.random.default_rng(seed)
+        points = rng.integers(0, self.value.size, (n_samples, self.value.size))
+        thickness = rng.integers(0, self.ice_thickness.size, (n_samples, self.ice_thickness.size))
+        design = self._design(np.log(self.value))[points]
+        target = self.height[points] + self.ice_thickness[thickness].mean(axis=1)[:, None]
+        return np.matmul(np.linalg.pinv(design), target[..., None])[..., 0]
+
+    def monte_carlo_sigma(self, values, n_samples=200, seed=None, chunk_size=2 ** 14):
+        """ Standard deviation of the distance for an array of EM values over bootstrap resamples
+            of the calibration (see bootstrap) combined with the scatter of the calibration points around the fit.
+            Values are processed in chunks to limit the memory used for the (chunk, n_samples) distances.
+        """
+        coefficients = self.bootstrap(n_samples, seed)
+        x = np.log(np.asarray(values, dtype=float))
+        result = np.empty(x.size)
+        for start in range(0, x.size, chunk_size):
+            distance = self._design(x[start:start + chunk_size]).dot(coefficients.T)
+            result[start:start + chunk_size] = distance.std(axis=1)
+        return np.sqrt(result ** 2 + self.residual_variance)
+
+    def apply(self, values, em_height):
+        """ Sum of ice and snow thickness for EM values.
+            *values* can be a numpy array, a pandas Series, or a pandas DataFrame with "data" column.
+            A numpy array is returned for array input, a pandas Series with the same index otherwise.
+        """
+        if isinstance(values, pd.DataFrame):
+            values = values['data']
+        result = self.distance(values) - float(em_height)
+        if isinstance(values, pd.Series):
+            return pd.Series(result, index=values.index)
+        return result
+
+
+def _error_values(df, error):
+    """ Error given as a number (m) or as a name of a column with the error of every point. """
+    if isinstance(error, str):
+        return df[error].values.astype(float)
+    return float(error)
+
+
+def position_sigma(df, thickness, gps_error=GPS_ERROR, drift_error=0.):
+    """ Thickness uncertainty caused by the position error: change of the thickness along the track
+        over the distance of the position error.
+        The position error combines *gps_error* and *drift_error* (residuals of the drift correction),
+        each of them is a number (m) or a name of a column.
+        Corrected coordinates ('lat_corr', 'lon_corr') are used if available, zeros are returned without coordinates.
+    """
+    if 'lat_corr' in df.columns and 'lon_corr' in df.columns:
+        lat, lon = df.lat_corr.values, df.lon_corr.values
+    elif 'lat' in df.columns and 'lon' in df.columns:
+        lat, lon = df.lat.values, df.lon.values
+    else:
+        return np.zeros(len(df))
+    if len(df) < 2:
+        return np.zeros(len(df))
+    error = np.sqrt(_error_values(df, gps_error) ** 2 + _error_values(df, drift_error) ** 2)
+    x, y = to_local_xy(lat, lon, np.nanmean(lat), np.nanmean(lon))
+    dx, dy = np.diff(x), np.diff(y)
+    step = np.sqrt(dx * dx + dy * dy)
+    """ Steps shorter than the position error are stretched to it, so the term never exceeds the local change. """
+    np.maximum(step, np.maximum(error[1:], error[:-1]) if np.ndim(error) else error, out=step)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        gradient = np.abs(np.diff(thickness)) / step
+    gradient[~np.isfinite(gradient)] = 0.
+    result = np.empty(len(df))
+    result[0], result[-1] = gradient[0], gradient[-1]
+    np.add(gradient[1:], gradient[:-1], out=result[1:-1])
+    result[1:-1] /= 2
+    return result * error
+
+
+@profiled
+def estimate_height(df, calibration_csv, em_height, uncertainty=None, gps_error=GPS_ERROR, drift_error=0.,
+                    n_samples=200, seed=None):
     """ Function estimates hight of the EM device above the water-ice interface.
         Exponential fit for calibration data is used.
         *calibration* is expected to be a *.csv file with the following coluns:
-        'height' and 'value' for calibration points, and 'ice_thickness' with some contact measurements of sea ice thickness.
+        'height' and 'value' for calibration points, and 'ice_thickness' with some contact measurements of sea ice thickness,
+        or a Calibration object.
         *em_height* is the height if the EM device above the snow surface.
+        *uncertainty* is one of the following:
+            None           only the thickness is estimated, the default;
+            'linear'       linear propagation of the calibration fit uncertainty (Calibration.sigma);
+            'monte_carlo'  bootstrap of the calibration with *n_samples* resamples (Calibration.monte_carlo_sigma).
+        The calibration uncertainty is combined with the position error (see position_sigma),
+        *gps_error* and *drift_error* are numbers (m) or names of columns.
         This function modifies the input DataFrame by adding the following column(s):
-        'ice_and_snow'.
+        'ice_and_snow', and 'ice_and_snow_sigma' if *uncertainty* is given.
     """
     if type(df) is not pd.DataFrame:
         print('df is expected to be a pandas DataFrame structure with "data" column.')
@@ -24,25 +258,29 @@ def estimate_height(df, calibration_csv, em_height):
         print('Input DataFrame does not have "data" column.')
         return False
 
-    try:
-        calibration = pd.read_csv(calibration_csv)
-    except:
-        print('Could not read the calibration csv file {0}.'.format(calibration_csv))
-        return False
-    """ Check for the required columns in the calibration data. """
-    if 'height' not in calibration.columns:
-        print("The 'height' column is not found in the calibration csv file.")
-        return False
-    if 'value' not in calibration.columns:
-        print("The 'value' column is not found in the calibration csv file.")
+    if isinstance(calibration_csv, Calibration):
+        calibration = calibration_csv
+    else:
+        calibration = Calibration.from_csv(calibration_csv)
+    if calibration is None:
         return False
-    if 'ice_thickness' not in calibration.columns:
-        print("The 'ice_thicknes' column is not found in the calibration csv file.")
+
+    if uncertainty not in (None, 'linear', 'monte_carlo'):
+        print('Unknown uncertainty mode {0}, possible values are "linear", "monte_carlo".'.format(uncertainty))
         return False
-    
-    average_ice_thickness = calibration.ice_thickness.mean()
-    fit_function = np.polyfit(np.log(calibration.value), calibration.height + average_ice_thickness, 1)
-    df['ice_and_snow'] = fit_function[1] + fit_function[0] * np.log(df.data) - em_height
+    for error in [gps_error, drift_error]:
+        if isinstance(error, str) and error not in df.columns:
+            print('Input DataFrame does not have "{0}" column.'.format(error))
+            return False
+
+    df['ice_and_snow'] = calibration.distance(df.data.values) - float(em_height)
+    if uncertainty == 'linear':
+        sigma = calibration.sigma(df.data.values)
+    elif uncertainty == 'monte_carlo':
+        sigma = calibration.monte_carlo_sigma(df.data.values, n_samples, seed)
+    else:
+        return True
+    df['ice_and_snow_sigma'] = np.hypot(sigma, position_sigma(df, df.ice_and_snow.values, gps_error, drift_error))
     return True
 
 
@@ -50,18 +288,32 @@ if __name__ == '__main__':
     desc = """ Script calculates sum of snow and ice thickness for data collected with EM device.
                Exponential fit for calibration data is used.
                Arguments:
-               -i           input file
-               -o           output file
+               -i           input file (.npz, .parquet, or .csv)
+               -o           output file, the format is given by the extension
                -cal         calibration csv file
                -em_height   height of the EM device above the snow surface
             All the arguments above should be specified.
+               -sigma       add uncertainty of the thickness: linear or monte_carlo (optional)
+               -gps_error   GPS position error (m) or a column with it, default is 3
+               -drift_error drift correction error (m) or a column with it, default is 0
+               -samples     number of calibration resamples for monte_carlo, default is 200
+               -cache       directory for cached parsed files (optional)
+               -profile     save profiling report to a json file (optional), default is em31_profile.json
            """
     parser = argparse.ArgumentParser(description=desc)
     parser.add_argument('-i', help='Input file name.')
     parser.add_argument('-o', help='Output file name.')
     parser.add_argument('-cal', help='Calibration csv file.')
     parser.add_argument('-em_height', help='EM device height above the snow surface.')
+    parser.add_argument('-sigma', help='Uncertainty estimate: linear or monte_carlo (optional).')
+    parser.add_argument('-gps_error', help='GPS position error (m) or a column name, default is 3.')
+    parser.add_argument('-drift_error', help='Drift correction error (m) or a column name, default is 0.')
+    parser.add_argument('-samples', help='Number of calibration resamples for monte_carlo, default is 200.')
+    parser.add_argument('-cache', help='Directory for cached parsed files (optional).')
+    parser.add_argument('-profile', nargs='?', const=DEFAULT_REPORT, help='Save profiling report to a json file (optional).')
     args = parser.parse_args()
+    if args.profile:
+        enable_profiling(args.profile)
 
     """ Check mandatory arguments """
     if not args.i:
@@ -78,16 +330,26 @@ if __name__ == '__main__':
         sys.exit()
     
     try:
-        data = pd.read_csv(args.i)
+        if args.cache:
+            data = cached_read(read_table, args.i, cache_dir=args.cache)
+        else:
+            data = read_table(args.i)
     except:
-        print('Unable to read csv file {0}'.format(args.i))
+        print('Unable to read file {0}'.format(args.i))
         sys.exit()
-    res = estimate_height(data, args.cal, args.em_height)
+    errors = []
+    for error, default in [(args.gps_error, GPS_ERROR), (args.drift_error, 0.)]:
+        try:
+            errors.append(float(error) if error else default)
+        except ValueError:
+            errors.append(error)
+    res = estimate_height(data, args.cal, args.em_height, args.sigma, errors[0], errors[1],
+                          int(args.samples) if args.samples else 200)
     if not res:
         print('Something went wrong during the ice and snow thicknes calculation. Check messages above.')
         sys.exit()
     
-    data.to_csv(args.o)
+    write_table(data, args.o)
 
     """
     calibration_heights = np.array([12, 32, 45, 55, 62, 70, 86, 95, 110, 120, 145, 168, 191, 212, 225])
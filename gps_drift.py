@@ -1,84 +1,323 @@
 
 """ Drift correction with additional GPS trackers.
     Since distance between GPS trackers does not change, it can be used to improve position error (to be implemented).
-    Two or more tracks gives opportunity to filter out outlying point of GPS track (to be implemented).
+    Two or more tracks gives opportunity to filter out outlying point of GPS track (outlier_mask, filter_outliers):
+    fixes are checked against rolling median positions, plausible drift speed and acceleration,
+    and the distances to the other trackers.
 """
 import numpy as np
 import pandas as pd
 
+from profiling import profiled
+from read_gpx import parse_time
+from survey_io import read_table
+
+
+R = 6371000.             # Earth radius, m
+
+
+def drift_kernel(time, lat, lon, tracker=None):
+    """ Vectorized drift between consecutive GPS fixes.
+        *time* is an array of datetime64 values, *lat* and *lon* are arrays in degrees.
+        *tracker* is an optional array of tracker ids, the drift is calculated for every tracker separately.
+        Returns a dictionary of arrays: 'd_lat', 'd_lon' (degrees), 'drift_meters', 'd_time_sec',
+        'drift_rate' (m/s) and 'd_angle' (central angle in radians).
+        The values are NaN for the first fix of every tracker.
+    """
+    t = np.asarray(time, dtype='datetime64[ns]').astype(np.int64)
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    if tracker is not None:
+        tracker = np.asarray(tracker)
+        order = np.lexsort((t, tracker))
+        t, lat, lon, tracker = t[order], lat[order], lon[order], tracker[order]
+
+    d_lat = np.empty_like(lat)
+    d_lon = np.empty_like(lon)
+    d_time_sec = np.empty_like(lat)
+    d_lat[:1] = d_lon[:1] = d_time_sec[:1] = np.nan
+    np.subtract(lat[1:], lat[:-1], out=d_lat[1:])
+    np.subtract(lon[1:], lon[:-1], out=d_lon[1:])
+    d_time_sec[1:] = (t[1:] - t[:-1]) / 1e9
+    if tracker is not None:
+        first = np.concatenate([[True], tracker[1:] != tracker[:-1]])
+        d_lat[first] = d_lon[first] = d_time_sec[first] = np.nan
+
+    """ Haversine formula keeps precision for small displacements. """
+    phi = np.radians(lat)
+    d_phi = np.radians(d_lat)
+    d_lambda = np.radians(d_lon)
+    cos_phi = np.cos(phi)
+    cos_phi_prev = np.empty_like(cos_phi)
+    cos_phi_prev[:1] = np.nan
+    cos_phi_prev[1:] = cos_phi[:-1]
+    a = np.sin(d_phi / 2) ** 2 + cos_phi * cos_phi_prev * np.sin(d_lambda / 2) ** 2
+    d_angle = 2 * np.arcsin(np.sqrt(np.minimum(a, 1.)))
+    drift_meters = R * d_angle
+    with np.errstate(divide='ignore', invalid='ignore'):
+        drift_rate = drift_meters / d_time_sec
+
+    result = {'d_lat': d_lat, 'd_lon': d_lon, 'drift_meters': drift_meters, 'drift_rate': drift_rate,
+              'd_time_sec': d_time_sec, 'd_angle': d_angle}
+    if tracker is not None:
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(order.size)
+        result = {key: value[inverse] for key, value in result.items()}
+    return result
+
+
+def to_local_xy(lat, lon, lat0, lon0):
+    """ Project coordinates (degrees) to metres east (x) and north (y) of the point (lat0, lon0).
+        Equirectangular projection is used, it is accurate enough within a few tens of kilometres.
+    """
+    x = R * np.radians(np.asarray(lon, dtype=float) - lon0) * np.cos(np.radians(lat0))
+    y = R * np.radians(np.asarray(lat, dtype=float) - lat0)
+    return x, y
+
+
+def from_local_xy(x, y, lat0, lon0):
+    """ Inverse of to_local_xy. """
+    lat = lat0 + np.degrees(np.asarray(y, dtype=float) / R)
+    lon = lon0 + np.degrees(np.asarray(x, dtype=float) / (R * np.cos(np.radians(lat0))))
+    return lat, lon
+
+
+def fit_rigid_transforms(local, observed):
+    """ Least-squares rigid transforms (rotation and translation) of a floe for many timepoints at once.
+        *local* is an array of shape (K, 2) with floe-fixed coordinates of K reference points (GPS trackers),
+        *observed* is an array of shape (T, K, 2) with their projected coordinates at T timepoints,
+        NaN values mark missing observations.
+        Returns rotation angles (T,) and translations (T, 2) such that observed = R(angle) * local + translation.
+        With one reference point only the translation is estimated (rotation is 0),
+        the result is NaN for timepoints without observations.
+    """
+    local = np.asarray(local, dtype=float)
+    observed = np.asarray(observed, dtype=float)
+    weight = (~np.isnan(observed).any(axis=2)).astype(float)
+    n = weight.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        observed = np.where(weight[..., None] > 0, observed, 0.)
+        observed_center = observed.sum(axis=1) / n[:, None]
+        local_center = weight.dot(local) / n[:, None]
+
+    """ Cross-covariance of the centered point sets gives the rotation angle (2D Kabsch algorithm). """
+    local_centered = local[None, :, :] - local_center[:, None, :]
+    observed_centered = observed - observed_center[:, None, :]
+    a = (weight * (local_centered[..., 0] * observed_centered[..., 0] + local_centered[..., 1] * observed_centered[..., 1])).sum(axis=1)
+    b = (weight * (local_centered[..., 0] * observed_centered[..., 1] - local_centered[..., 1] * observed_centered[..., 0])).sum(axis=1)
+    angle = np.arctan2(b, a)
+    cos = np.cos(angle)
+    sin = np.sin(angle)
+    translation = np.column_stack([observed_center[:, 0] - cos * local_center[:, 0] + sin * local_center[:, 1],
+                                   observed_center[:, 1] - sin * local_center[:, 0] - cos * local_center[:, 1]])
+    angle[n == 0] = np.nan
+    return angle, translation
+
 
 def estimate_drift(gps_data):
-    """ Input is expected to be a pandas dataframe with lat, lon, and time columns
+    """ Input is expected to be a pandas dataframe with lat, lon, and time columns,
+        or a list of such dataframes (one for every GPS tracker).
+        If there is a 'tracker' column (or a list is given), the drift is calculated for every tracker separately.
+        Returns a pandas DataFrame with the following columns:
+        'd_lat', 'd_lon', 'drift_meters', 'drift_rate', 'd_time_sec', 'd_angle', 'time' (and 'tracker').
     """
-    R = 6400000             # Earth radius
-    base_point_index = 0
-    base_lat = gps_data['lat'][base_point_index]
-    base_lon = gps_data['lon'][base_point_index]
-    base_time = gps_data['time'][base_point_index]
-    lat_rel = gps_data['lat'] - base_lat
-    lon_rel = gps_data['lon'] - base_lon
-
-    d_lat = gps_data['lat'].diff()
-    d_lon = gps_data['lon'].diff()
-    d_angle = np.arccos(np.sin(gps_data['lon']) * np.sin(gps_data['lon'].shift(1)) + np.cos(gps_data['lon']) * np.cos(gps_data['lon'].shift(1)) * np.cos(gps_data['lat'].diff()))
-    d_lat_meters = d_lat / 180. * np.pi * R
-    d_lon_meters = d_lon / 180. * np.pi * R * np.cos(gps_data['lat'])
-#    d_abs_meters = np.linalg.norm(d_lat_meters, d_lon_meters)
-    d_abs_meters = (d_lat_meters**2 + d_lon_meters**2)**0.5
-    d_time = gps_data['time'].diff()
-    d_time_sec = pd.Series([i.seconds for i in d_time])
-    d_rate = d_abs_meters / d_time_sec
-
-    drift = pd.DataFrame()
-    drift['d_lat'] = d_lat
-    drift['d_lon'] = d_lon
-    drift['drift_meters'] = d_abs_meters
-    drift['drift_rate'] = d_rate
-    drift['d_time_sec'] = d_time_sec
-    drift['d_angle'] = d_angle
+    if isinstance(gps_data, (list, tuple)):
+        gps_data = pd.concat(gps_data, keys=np.arange(1, len(gps_data) + 1), names=['tracker', None]).reset_index(level=0)
+    tracker = gps_data['tracker'].values if 'tracker' in gps_data.columns else None
+    time = pd.to_datetime(gps_data['time']).values
+    drift = pd.DataFrame(drift_kernel(time, gps_data['lat'].values, gps_data['lon'].values, tracker), index=gps_data.index)
     drift['time'] = gps_data['time']
-    return drift
+    if tracker is not None:
+        drift['tracker'] = tracker
+    return drift.reset_index(drop=True)
+
+
+def _rolling_median(values, window):
+    return pd.Series(values).rolling(window, center=True, min_periods=1).median().values
+
+
+def _metres(d_lat, d_lon, lat):
+    """ Distance in metres for differences of coordinates (degrees) around latitude *lat*.
+        Accurate for distances up to a few kilometres (trackers on one floe, consecutive fixes).
+    """
+    return R * np.hypot(np.radians(d_lat), np.radians(d_lon) * np.cos(np.radians(lat)))
 
 
-def interpolate_tracks(track_file_list, frequency='1S'):
+def outlier_mask(gps_data, max_speed=2., max_acceleration=1e-3, position_error=10., window=61, n_mad=4.,
+                 baseline_tolerance=None):
+    """ Flag outlying GPS fixes. Input is the same as for estimate_drift: a pandas DataFrame with lat, lon,
+        and time columns (and optional 'tracker' column), or a list of such DataFrames (one for every tracker).
+        A fix is an outlier if any of the following tests fails:
+            median      distance from the rolling median position (*window* fixes of the same tracker) is larger
+                        than *n_mad* robust standard deviations (1.4826 * rolling median of the distances)
+                        plus *position_error* (metres);
+            speed       both the fix before and the fix after are further than the drift at *max_speed* (m/s)
+                        plus twice the position error;
+            acceleration    the fix deviates from the line between its neighbours more than constant
+                        acceleration *max_acceleration* (m/s^2) plus twice the position error allows,
+                        and more than its neighbours do (a spike moves the neighbours' estimates too);
+            baseline    distance to the rolling median position of every other tracker (interpolated to the time
+                        of the fix) deviates from its rolling median by more than *baseline_tolerance* metres,
+                        three position errors by default. The trackers are fixed on the same floe, so the
+                        distances between them stay the same.
+        Fixes with NaN coordinates are outliers as well.
+        Returns a boolean numpy array in the order of the rows (of the concatenated DataFrames for a list).
+    """
+    if isinstance(gps_data, (list, tuple)):
+        gps_data = pd.concat(gps_data, keys=np.arange(1, len(gps_data) + 1), names=['tracker', None]).reset_index(level=0)
+    if baseline_tolerance is None:
+        baseline_tolerance = 3 * position_error
+    t = np.asarray(pd.to_datetime(gps_data['time']).values, dtype='datetime64[ns]').astype(np.int64)
+    lat = gps_data['lat'].values.astype(float)
+    lon = gps_data['lon'].values.astype(float)
+    tracker = gps_data['tracker'].values if 'tracker' in gps_data.columns else np.zeros(t.size, dtype=int)
+    order = np.lexsort((t, tracker))
+    t, lat, lon, tracker = t[order], lat[order], lon[order], tracker[order]
+    outlier = np.isnan(lat) | np.isnan(lon)
+
+    """ Rolling medians are calculated for every tracker separately on the valid fixes. """
+    median_lat = np.full(t.size, np.nan)
+    median_lon = np.full(t.size, np.nan)
+    scale = np.full(t.size, np.nan)
+    segments = np.flatnonzero(np.concatenate([[True], tracker[1:] != tracker[:-1], [True]]))
+    for start, end in zip(segments[:-1], segments[1:]):
+        valid = start + np.flatnonzero(~outlier[start:end])
+        median_lat[valid] = _rolling_median(lat[valid], window)
+        median_lon[valid] = _rolling_median(lon[valid], window)
+        scale[valid] = _rolling_median(_metres(lat[valid] - median_lat[valid], lon[valid] - median_lon[valid], lat[valid]), window)
+    distance = _metres(lat - median_lat, lon - median_lon, lat)
+    with np.errstate(invalid='ignore'):
+        outlier |= distance > n_mad * 1.4826 * scale + position_error
+
+    """ Speed and acceleration tests use the neighbouring fixes of the same tracker. """
+    same = np.concatenate([[False], tracker[1:] == tracker[:-1]])
+    dt = np.where(same, np.concatenate([[0], np.diff(t)]) / 1e9, np.nan)
+    step = np.where(same, np.concatenate([[np.nan], _metres(np.diff(lat), np.diff(lon), lat[1:])]), np.nan)
+    dt_next = np.concatenate([dt[1:], [np.nan]])
+    step_next = np.concatenate([step[1:], [np.nan]])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        outlier |= (step > max_speed * dt + 2 * position_error) & (step_next > max_speed * dt_next + 2 * position_error)
+        fraction = dt / (dt + dt_next)
+        lat_next = np.concatenate([lat[1:], [np.nan]])
+        lon_next = np.concatenate([lon[1:], [np.nan]])
+        lat_prev = np.concatenate([[np.nan], lat[:-1]])
+        lon_prev = np.concatenate([[np.nan], lon[:-1]])
+        deviation = _metres(lat - lat_prev - fraction * (lat_next - lat_prev), lon - lon_prev - fraction * (lon_next - lon_prev), lat)
+        deviation = np.where(np.isnan(deviation), -np.inf, deviation)
+        outlier |= ((deviation > max_acceleration * dt * dt_next / 2 + 2 * position_error)
+                    & (deviation >= np.concatenate([[-np.inf], deviation[:-1]]))
+                    & (deviation >= np.concatenate([deviation[1:], [-np.inf]])))
+
+    """ Baseline test: distances to every other tracker. """
+    trackers = tracker[segments[:-1]]
+    if trackers.size > 1:
+        failed = np.zeros(t.size, dtype=int)
+        compared = np.zeros(t.size, dtype=int)
+        for i, (start, end) in enumerate(zip(segments[:-1], segments[1:])):
+            for j, (other_start, other_end) in enumerate(zip(segments[:-1], segments[1:])):
+                if i == j:
+                    continue
+                valid = other_start + np.flatnonzero(~np.isnan(median_lat[other_start:other_end]))
+                if valid.size < 2:
+                    continue
+                other_lat = np.interp(t[start:end], t[valid], median_lat[valid], left=np.nan, right=np.nan)
+                other_lon = np.interp(t[start:end], t[valid], median_lon[valid], left=np.nan, right=np.nan)
+                baseline = _metres(lat[start:end] - other_lat, lon[start:end] - other_lon, lat[start:end])
+                known = ~np.isnan(baseline)
+                reference = np.full(end - start, np.nan)
+                reference[known] = _rolling_median(baseline[known], window)
+                with np.errstate(invalid='ignore'):
+                    failed[start:end] += np.abs(baseline - reference) > baseline_tolerance
+                compared[start:end] += known
+        """ A fix is rejected only if it is inconsistent with all the trackers it is compared with. """
+        outlier |= (compared > 0) & (failed == compared)
+
+    result = np.empty_like(outlier)
+    result[order] = outlier
+    return result
+
+
+def filter_outliers(gps_data, **kwargs):
+    """ Drop outlying GPS fixes found with outlier_mask (keyword arguments are passed to it).
+        Returns a pandas DataFrame, or a list of DataFrames if a list is given.
+    """
+    mask = outlier_mask(gps_data, **kwargs)
+    if isinstance(gps_data, (list, tuple)):
+        bounds = np.cumsum([0] + [item.shape[0] for item in gps_data])
+        return [item[~mask[start:end]] for item, start, end in zip(gps_data, bounds[:-1], bounds[1:])]
+    return gps_data[~mask]
+
+
+def interpolate_track(track, times):
+    """ Interpolate coordinates of a GPS track at given times.
+        *track* is expected to be a pandas DataFrame with lat, lon, and time columns,
+        *times* is an array of datetime64 values (e.g. timestamps of EM measurements).
+        Returns arrays of latitudes and longitudes, NaN for times outside of the track.
+    """
+    t = np.asarray(track['time'].values, dtype='datetime64[ns]').astype(np.int64)
+    lat = track['lat'].values
+    lon = track['lon'].values
+    if np.any(t[1:] < t[:-1]):
+        order = np.argsort(t, kind='stable')
+        t, lat, lon = t[order], lat[order], lon[order]
+    query = np.asarray(times, dtype='datetime64[ns]').astype(np.int64)
+    return (np.interp(query, t, lat, left=np.nan, right=np.nan),
+            np.interp(query, t, lon, left=np.nan, right=np.nan))
+
+
+def align_tracks(tracks, times=None, frequency='1s'):
+    """ Interpolate several GPS tracks to common times.
+        *tracks* is a list of pandas DataFrames with lat, lon, and time columns.
+        If *times* is not given, the tracks are interpolated to a regular grid with the given frequency
+        over the time interval covered by all the tracks.
+        Returns a pandas DataFrame indexed by time with 'time' column and (i, 'lat'), (i, 'lon') columns
+        for every track (i starts from 1). Times not covered by all the tracks are dropped.
+    """
+    if times is None:
+        start_time = max([np.asarray(item['time'].values, dtype='datetime64[ns]').min() for item in tracks])
+        end_time = min([np.asarray(item['time'].values, dtype='datetime64[ns]').max() for item in tracks])
+        step = pd.Timedelta(frequency).value
+        times = np.arange(start_time.astype(np.int64), end_time.astype(np.int64) + 1, step).astype('datetime64[ns]')
+    else:
+        times = np.asarray(times, dtype='datetime64[ns]')
+
+    columns = {'time': times}
+    valid = np.ones(times.shape, dtype=bool)
+    for i, item in enumerate(tracks):
+        lat, lon = interpolate_track(item, times)
+        columns[(i + 1, 'lat')] = lat
+        columns[(i + 1, 'lon')] = lon
+        valid &= ~np.isnan(lat)
+    track = pd.DataFrame(columns)[valid]
+    track.index = track.time
+    return track
+
+
+@profiled
+def interpolate_tracks(track_file_list, frequency='1s', times=None, remove_outliers=False):
     """ Function creates a pandas DataFrame with both trackes interpolated for given frequency.
         Default frequency is one second.
         This means that there are GPS two coordinates for each second.
+        If *times* are given, the tracks are interpolated to these times instead of a regular grid.
+        If *remove_outliers* is True, outlying fixes are dropped with filter_outliers before the interpolation.
     """
-    """ Read and join GPS tracks. """
     tracks = [read_track(item) for item in track_file_list]
-    joined_tracks = pd.concat(tracks, axis='columns', join='outer', keys=np.arange(1, len(tracks) + 1))
-
-    """ Create a new pandas DataFrame. """
-    start_time = min([item.time[0] for item in tracks])
-    end_time = max([item.time[item.shape[0] - 1] for item in tracks])
-    track = pd.DataFrame(pd.date_range(start=start_time, end=end_time, freq=frequency))
-    track.columns = ['time']
-
-    """ Interpolate all GPS tracks. """
-    track = track.join(joined_tracks, on='time', how='outer')
-    track = track.drop(columns=[(i + 1, 'time') for i, _ in enumerate(tracks)])
-    for i, _ in enumerate(tracks):
-        track[(i + 1, 'lat')].interpolate(method='linear', inplace=True)
-        track[(i + 1, 'lon')].interpolate(method='linear', inplace=True)
-    track.index = track.time
-    track.dropna(axis='index', how='any', inplace=True)
-    return track
+    if remove_outliers:
+        tracks = filter_outliers(tracks)
+    return align_tracks(tracks, times, frequency)
 
 
+@profiled
 def read_track(track_file):
     """ Read GPS track """
-    track = pd.read_csv(track_file)
-    track['time'] = track.time.apply(__detect_time)
+    track = read_table(track_file)
+    if not pd.api.types.is_datetime64_any_dtype(track.time):
+        track['time'] = parse_time(track.time.values)
     track.index = track.time
     track = track.filter(['lat', 'lon', 'time'])
     return track
 
 
-def __detect_time(x):
-    return pd.datetime.strptime(x, '%Y-%m-%dT%H:%M:%SZ')
-
-
 def calculate_drift(tracks, zero_time):
     """ Calculate drift for every timepoint from tracks.
         The drift is calculated relativly to the zero_time (time of zero drift).
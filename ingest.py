@@ -0,0 +1,338 @@
+""" Ingestion of data from a drift station: several GPS trackers and the EM-31 are read at once.
+    Every device has a source of text lines: a serial port, a file that is being written, a TCP or UDP stream
+    of NMEA sentences, or a replay of recorded lines (stand-in for a device in tests).
+    Lines are collected into batches and decoded in one array operation. Batches go through one bounded
+    asyncio queue: when the consumer falls behind, readers wait (backpressure) instead of growing the memory.
+    Fixes of GPS trackers are appended to the reference series of an IceFloe, recent records of every device
+    are kept in a fixed-size ring buffer.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from drift_station import IceFloe
+from nmea import day_rollover, parse_gga, to_datetime64
+from read_r31 import R31Parser
+
+
+QUEUE_SIZE = 1000
+RING_SIZE = 2 ** 12
+RECORD_DTYPE = [('time', 'datetime64[ns]'), ('lat', float), ('lon', float), ('data', float)]
+
+
+class RingBuffer(object):
+    """ Fixed-size buffer of the last *capacity* records (numpy structured array), the oldest records are
+        overwritten. Writing a batch is one vectorized assignment.
+    """
+    def __init__(self, capacity=RING_SIZE, dtype=RECORD_DTYPE):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        self.total = 0
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def push(self, records):
+        """ Write a structured array of records. """
+        records = records[-self.capacity:]
+        self.data[(self.total + np.arange(records.size)) % self.capacity] = records
+        self.total += records.size
+
+    def latest(self, n=None):
+        """ Copy of the last *n* records (all the stored records by default), the oldest first. """
+        n = len(self) if n is None else min(n, len(self))
+        return self.data[(self.total - n + np.arange(n)) % self.capacity]
+
+
+class Device(object):
+    """ Data source of a drift station.
+        *source* is an async iterable of text lines (see serial_lines, file_lines, tcp_lines, udp_lines,
+        replay_lines). *kind* is 'gps' for GPS trackers sending GPGGA sentences, or 'em31' for the EM-31 log.
+        Fixes of a GPS tracker are added to the reference point *point_id* of the floe.
+        *date* is the UTC date of the first fix (today by default), days are counted from the NMEA times.
+        Lines are decoded in batches of *batch_size* lines, or of the lines received during *flush_interval* seconds.
+    """
+    def __init__(self, name, source, kind='gps', point_id=None, date='', batch_size=100, flush_interval=1.,
+                 ring_size=RING_SIZE):
+        self.name = name
+        self.source = source
+        self.kind = kind
+        self.point_id = point_id
+        self.date = pd.Timestamp(date) if date else pd.Timestamp.now('UTC').tz_localize(None).normalize()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.ring = RingBuffer(ring_size)
+        self.parser = R31Parser(self.date.strftime('%Y%m%d')) if kind == 'em31' else None
+        self.seconds = np.nan
+        self.days = 0
+        self.stats = {'lines': 0, 'records': 0, 'batches': 0}
+
+    def decode(self, lines):
+        """ Structured array of records for a batch of lines. """
+        if self.kind == 'em31':
+            df = self.parser.feed('\n'.join(lines) + '\n')
+            records = np.zeros(df.shape[0], dtype=RECORD_DTYPE)
+            for name in ['time', 'lat', 'lon', 'data']:
+                records[name] = df[name].values
+            return records
+        seconds, lat, lon = parse_gga(lines)
+        days = self.days + day_rollover(seconds, self.seconds)
+        if seconds.size:
+            self.seconds, self.days = seconds[-1], days[-1]
+        records = np.zeros(seconds.size, dtype=RECORD_DTYPE)
+        records['time'] = to_datetime64(self.date, days, seconds)
+        records['lat'] = lat
+        records['lon'] = lon
+        records['data'] = np.nan
+        return records
+
+
+class IngestService(object):
+    """ Read all the *devices* concurrently and push their data into the *floe* (drift_station.IceFloe).
+        Reference points of GPS trackers missing in the floe are added.
+        *on_records* is called with the device and a structured array of every batch (e.g. to save EM-31 data).
+    """
+    def __init__(self, floe, devices, queue_size=QUEUE_SIZE, on_records=None):
+        self.floe = floe
+        self.devices = devices
+        self.queue_size = queue_size
+        self.on_records = on_records
+        self._readers = []
+        for device in devices:
+            if device.kind == 'gps' and device.point_id.lower() not in floe.reference_points:
+                floe.add_reference_point(device.point_id)
+
+    async def run(self):
+        """ Run until all the sources are exhausted or stop is called.
+            Returns statistics: number of lines, records and batches for every device.
+        """
+        queue = asyncio.Queue(self.queue_size)
+        self._readers = [asyncio.ensure_future(self._read(device, queue)) for device in self.devices]
+        consumer = asyncio.ensure_future(self._consume(queue))
+        await asyncio.gather(*self._readers)
+        await queue.put(None)
+        await consumer
+        return {device.name: device.stats for device in self.devices}
+
+    def stop(self):
+        """ Stop reading, the lines already read are still processed. """
+        for task in self._readers:
+            task.cancel()
+
+    async def _read(self, device, queue):
+        lines = []
+        last_flush = time.monotonic()
+        try:
+            async for line in device.source:
+                lines.append(line)
+                if len(lines) >= device.batch_size or time.monotonic() - last_flush >= device.flush_interval:
+                    await queue.put((device, lines))
+                    lines = []
+                    last_flush = time.monotonic()
+        except asyncio.CancelledError:
+            pass
+        if lines:
+            await queue.put((device, lines))
+
+    async def _consume(self, queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            device, lines = item
+            records = device.decode(lines)
+            device.stats['lines'] += len(lines)
+            device.stats['records'] += records.size
+            device.stats['batches'] += 1
+            if not records.size:
+                continue
+            device.ring.push(records)
+            if device.kind == 'gps':
+                self.floe.add_fixes(device.point_id, records['time'], records['lat'], records['lon'])
+            if self.on_records is not None:
+                self.on_records(device, records)
+
+
+""" Sources: async generators of text lines without line breaks. """
+
+
+async def serial_lines(port, baudrate=4800, timeout=1.):
+    """ Lines from a serial port. Requires pyserial, reading is done in a thread so the event loop is not blocked. """
+    try:
+        import serial
+    except ImportError:
+        print('pyserial is required to read from serial ports (pip install pyserial).')
+        return
+    loop = asyncio.get_event_loop()
+    connection = serial.Serial(port, baudrate, timeout=timeout)
+    try:
+        while True:
+            line = await loop.run_in_executor(None, connection.readline)
+            if line:
+                yield line.decode('ascii', errors='replace').rstrip('\r\n')
+    finally:
+        connection.close()
+
+
+async def file_lines(path, poll_interval=0.5, from_start=True):
+    """ Lines of a file that is still being written, new lines are polled every *poll_interval* seconds. """
+    with open(path, 'r') as f:
+        if not from_start:
+            f.seek(0, os.SEEK_END)
+        tail = ''
+        while True:
+            text = f.read()
+            if not text:
+                await asyncio.sleep(poll_interval)
+                continue
+            lines = (tail + text).split('\n')
+            tail = lines.pop()
+            for line in lines:
+                yield line.rstrip('\r')
+
+
+async def tcp_lines(host, port):
+    """ Lines from a TCP stream (e.g. NMEA over TCP from a GPS receiver or a serial-to-network converter). """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            yield line.decode('ascii', errors='replace').rstrip('\r\n')
+    finally:
+        writer.close()
+
+
+class _DatagramQueue(asyncio.DatagramProtocol):
+    """ UDP datagrams cannot be held back, if the queue is full the datagram is dropped and counted. """
+    def __init__(self, queue):
+        self.queue = queue
+        self.dropped = 0
+
+    def datagram_received(self, data, addr):
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped == 1:
+                print('UDP queue is full, datagrams are dropped.')
+
+
+async def udp_lines(host, port, queue_size=QUEUE_SIZE * 10):
+    """ Lines from UDP datagrams sent to host:port, a datagram may contain several lines. """
+    queue = asyncio.Queue(queue_size)
+    transport, _ = await asyncio.get_event_loop().create_datagram_endpoint(lambda: _DatagramQueue(queue),
+                                                                           local_addr=(host, port))
+    try:
+        while True:
+            data = await queue.get()
+            for line in data.decode('ascii', errors='replace').splitlines():
+                yield line
+    finally:
+        transport.close()
+
+
+async def replay_lines(lines, rate=None):
+    """ Replay recorded lines at *rate* lines per second (as fast as possible if not given).
+        Stand-in for a device in tests and simulations.
+    """
+    interval = 1. / rate if rate else 0.
+    start = time.monotonic()
+    for i, line in enumerate(lines):
+        """ Sleep until the scheduled time of the line, so the rate does not drift. """
+        await asyncio.sleep(max(start + i * interval - time.monotonic(), 0.))
+        yield line
+
+
+def open_source(spec):
+    """ Source for a specification string: serial:PORT[:BAUDRATE], file:PATH, tcp:HOST:PORT, udp:HOST:PORT,
+        or replay:PATH[:RATE] (lines of a recorded file at RATE lines per second).
+    """
+    kind, _, rest = spec.partition(':')
+    if kind == 'serial':
+        port, _, baudrate = rest.partition(':')
+        return serial_lines(port, int(baudrate) if baudrate else 4800)
+    if kind == 'file':
+        return file_lines(rest)
+    if kind in ['tcp', 'udp']:
+        host, _, port = rest.rpartition(':')
+        return (tcp_lines if kind == 'tcp' else udp_lines)(host, int(port))
+    if kind == 'replay':
+        path, _, rate = rest.partition(':')
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+        return replay_lines(lines, float(rate) if rate else None)
+    print('Unknown source {0}, possible types are serial, file, tcp, udp, and replay.'.format(spec))
+    return None
+
+
+if __name__ == '__main__':
+    desc = """ Read GPS trackers and the EM-31 of a drift station and save the data.
+               Sources are given as serial:PORT[:BAUDRATE], file:PATH, tcp:HOST:PORT, udp:HOST:PORT, or replay:PATH[:RATE].
+               Arguments:
+               -gps         GPS tracker as POINT_ID=SOURCE, e.g. zero=tcp:localhost:10110 (can be repeated)
+               -em31        source of the EM-31 log (optional)
+               -o           output directory: one csv file per reference point and em31.csv
+               -d           UTC date of the first fix in the format %Y%m%d (optional), default is today
+               -name        name of the ice floe (optional)
+            Press Ctrl+C to stop.
+           """
+    parser = argparse.ArgumentParser(description=desc.replace('%', '%%'))
+    parser.add_argument('-gps', action='append', help='GPS tracker as POINT_ID=SOURCE.')
+    parser.add_argument('-em31', help='Source of the EM-31 log.')
+    parser.add_argument('-o', help='Output directory.')
+    parser.add_argument('-d', help='UTC date of the first fix in the format %%Y%%m%%d.')
+    parser.add_argument('-name', help='Name of the ice floe.')
+    args = parser.parse_args()
+
+    """ Check mandatory arguments """
+    if not args.gps and not args.em31:
+        print('At least one source should be specified with -gps or -em31 option.')
+        sys.exit()
+    if not args.o:
+        print('Output directory should be specified with -o option.')
+        sys.exit()
+
+    devices = []
+    for item in args.gps or []:
+        point_id, _, spec = item.partition('=')
+        source = open_source(spec)
+        if not spec or source is None:
+            print('GPS tracker should be given as POINT_ID=SOURCE, given value is {0}.'.format(item))
+            sys.exit()
+        devices.append(Device(point_id, source, 'gps', point_id, args.d or ''))
+    if args.em31:
+        source = open_source(args.em31)
+        if source is None:
+            sys.exit()
+        devices.append(Device('em31', source, 'em31', date=args.d or ''))
+
+    if not os.path.isdir(args.o):
+        os.makedirs(args.o)
+    em31_file = os.path.join(args.o, 'em31.csv')
+
+    def save_em31(device, records):
+        if device.kind == 'em31':
+            pd.DataFrame(records).to_csv(em31_file, mode='a', header=not os.path.isfile(em31_file), index=False)
+
+    floe = IceFloe(args.name or 'floe', 0)
+    service = IngestService(floe, devices, on_records=save_em31)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    task = loop.create_task(service.run())
+    try:
+        stats = loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        service.stop()
+        stats = loop.run_until_complete(task)
+    for point_id, series in floe.reference_points.items():
+        if len(series):
+            series.to_frame().to_csv(os.path.join(args.o, point_id + '.csv'), index=False)
+    for name, item in stats.items():
+        print('{0}: {1} lines, {2} records'.format(name, item['lines'], item['records']))
@@ -1,9 +1,171 @@
 """ Layer class definitino """
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+class TileStore(object):
+    """ Raster stored on disk as square tiles, one .npy file per tile.
+        Tiles are memory mapped when they are needed, recently used tiles are kept open (LRU cache of *cache_size* tiles).
+        Tiles that have never been written are not stored, reading them gives *fill_value*.
+        An existing store is opened if *shape* is not given.
+    """
+    def __init__(self, path, shape=None, tile_size=512, dtype='float32', fill_value=np.nan, cache_size=64):
+        self.path = path
+        self.cache_size = cache_size
+        self._tiles = OrderedDict()
+        meta_file = os.path.join(path, 'meta.json')
+        if shape is None:
+            with open(meta_file, 'r') as f:
+                meta = json.load(f)
+            self.shape = tuple(meta['shape'])
+            self.tile_size = meta['tile_size']
+            self.dtype = np.dtype(meta['dtype'])
+            self.fill_value = np.nan if meta['fill_value'] is None else meta['fill_value']
+        else:
+            self.shape = tuple(int(item) for item in shape)
+            self.tile_size = int(tile_size)
+            self.dtype = np.dtype(dtype)
+            self.fill_value = fill_value
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            with open(meta_file, 'w') as f:
+                json.dump({'shape': self.shape, 'tile_size': self.tile_size, 'dtype': self.dtype.str,
+                           'fill_value': None if np.isnan(fill_value) else fill_value}, f)
+
+    def _tile_file(self, tile_row, tile_col):
+        return os.path.join(self.path, 'tile_{0}_{1}.npy'.format(tile_row, tile_col))
+
+    def _tile(self, tile_row, tile_col, create=False):
+        """ Memory mapped tile, None if the tile does not exist and should not be created. """
+        key = (tile_row, tile_col)
+        if key in self._tiles:
+            self._tiles.move_to_end(key)
+            return self._tiles[key]
+        tile_file = self._tile_file(tile_row, tile_col)
+        if os.path.isfile(tile_file):
+            tile = np.load(tile_file, mmap_mode='r+')
+        elif create:
+            tile = np.lib.format.open_memmap(tile_file, mode='w+', dtype=self.dtype, shape=(self.tile_size, self.tile_size))
+            tile[:] = self.fill_value
+        else:
+            return None
+        self._tiles[key] = tile
+        if len(self._tiles) > self.cache_size:
+            _, old = self._tiles.popitem(last=False)
+            old.flush()
+        return tile
+
+    def _window_tiles(self, row0, row1, col0, col1):
+        """ Tiles overlapping the window with the corresponding slices of the tile and of the window. """
+        size = self.tile_size
+        for tile_row in range(row0 // size, (row1 - 1) // size + 1):
+            for tile_col in range(col0 // size, (col1 - 1) // size + 1):
+                r0 = max(row0, tile_row * size)
+                r1 = min(row1, (tile_row + 1) * size)
+                c0 = max(col0, tile_col * size)
+                c1 = min(col1, (tile_col + 1) * size)
+                yield (tile_row, tile_col,
+                       (slice(r0 - tile_row * size, r1 - tile_row * size), slice(c0 - tile_col * size, c1 - tile_col * size)),
+                       (slice(r0 - row0, r1 - row0), slice(c0 - col0, c1 - col0)))
+
+    def read_window(self, row0, row1, col0, col1):
+        """ Copy of the window [row0:row1, col0:col1] of the raster, only the overlapping tiles are read. """
+        row0, row1 = max(row0, 0), min(row1, self.shape[0])
+        col0, col1 = max(col0, 0), min(col1, self.shape[1])
+        result = np.full((max(row1 - row0, 0), max(col1 - col0, 0)), self.fill_value, dtype=self.dtype)
+        if not result.size:
+            return result
+        for tile_row, tile_col, tile_slice, window_slice in self._window_tiles(row0, row1, col0, col1):
+            tile = self._tile(tile_row, tile_col)
+            if tile is not None:
+                result[window_slice] = tile[tile_slice]
+        return result
+
+    def write_window(self, row0, col0, values):
+        """ Write a 2D array into the raster starting at (row0, col0), only the overlapping tiles are touched. """
+        values = np.asarray(values)
+        row1 = min(row0 + values.shape[0], self.shape[0])
+        col1 = min(col0 + values.shape[1], self.shape[1])
+        if row0 < 0 or col0 < 0:
+            raise ValueError('Window start ({0}, {1}) is outside of the raster.'.format(row0, col0))
+        if row1 <= row0 or col1 <= col0:
+            return
+        for tile_row, tile_col, tile_slice, window_slice in self._window_tiles(row0, row1, col0, col1):
+            self._tile(tile_row, tile_col, create=True)[tile_slice] = values[window_slice]
+
+    def flush(self):
+        for tile in self._tiles.values():
+            tile.flush()
+
 
 class Layer(object):
+    """ Raster layer. *data* is a 2D numpy array or a TileStore for rasters that do not fit into memory.
+        Both are accessed with read_window and write_window, so the code working with windows does not depend
+        on where the data is stored.
+    """
     def __init__(self, data, resolution, projection, timestamp, desc=''):
         self.desc = desc
         self.projection = projection
         self.data = data
         self.timestamp = timestamp
         self.resolution = resolution
+
+    @property
+    def shape(self):
+        return tuple(self.data.shape)
+
+    @property
+    def tiled(self):
+        return isinstance(self.data, TileStore)
+
+    def read_window(self, row0, row1, col0, col1):
+        """ Window [row0:row1, col0:col1] of the layer. A view is returned for in-memory layers. """
+        if self.tiled:
+            return self.data.read_window(row0, row1, col0, col1)
+        return self.data[max(row0, 0):row1, max(col0, 0):col1]
+
+    def write_window(self, row0, col0, values):
+        """ Write a 2D array into the layer starting at (row0, col0). """
+        if self.tiled:
+            self.data.write_window(row0, col0, values)
+            return
+        values = np.asarray(values)
+        target = self.data[row0:row0 + values.shape[0], col0:col0 + values.shape[1]]
+        target[...] = values[:target.shape[0], :target.shape[1]]
+
+    def to_tiles(self, path, tile_size=512, cache_size=64):
+        """ Layer with the same data stored as tiles in *path*. """
+        if self.tiled:
+            return self
+        store = TileStore(path, self.data.shape, tile_size, self.data.dtype, cache_size=cache_size)
+        for row0 in range(0, self.data.shape[0], tile_size):
+            for col0 in range(0, self.data.shape[1], tile_size):
+                window = self.data[row0:row0 + tile_size, col0:col0 + tile_size]
+                if not np.all(np.isnan(window)):
+                    store.write_window(row0, col0, window)
+        store.flush()
+        return Layer(store, self.resolution, self.projection, self.timestamp, self.desc)
+
+
+class LayerStack(object):
+    """ Time-stamped layers on the same grid, ordered by time, layers without a timestamp go first.
+        The layers are not copied, windows are read from every layer only when requested.
+    """
+    def __init__(self, layers):
+        self.layers = sorted(layers, key=lambda item: (item.timestamp is not None, item.timestamp))
+
+    @property
+    def timestamps(self):
+        return [item.timestamp for item in self.layers]
+
+    def between(self, start, end):
+        """ Stack of the layers with timestamps in [start, end], layers without a timestamp are not included. """
+        return LayerStack([item for item in self.layers
+                           if item.timestamp is not None and start <= item.timestamp <= end])
+
+    def read_window(self, row0, row1, col0, col1):
+        """ 3D array (time, rows, cols) with the window of every layer. """
+        return np.stack([item.read_window(row0, row1, col0, col1) for item in self.layers])
@@ -0,0 +1,97 @@
+""" Ice and snow thickness from an EM-31 log that is still being written.
+    New lines of the R31 file are parsed as they appear, every new measurement is converted
+    into thickness with the calibration fitted once, and pushed to a callback, an asyncio queue,
+    or printed to stdout as NDJSON (one JSON object per line).
+"""
+import argparse
+import asyncio
+import sys
+
+from estimate_thickness import Calibration
+from read_r31 import follow_r31, poll_r31
+
+
+def add_thickness(chunk, calibration, em_height):
+    """ Add 'ice_and_snow' column to a DataFrame with new measurements. """
+    chunk['ice_and_snow'] = calibration.apply(chunk['data'].values, em_height)
+    return chunk
+
+
+def to_ndjson(chunk):
+    """ Convert a DataFrame with measurements into NDJSON lines (without the last line break). """
+    return chunk.to_json(orient='records', lines=True, date_format='iso').rstrip('\n')
+
+
+def follow_thickness(inp_filename, calibration, em_height, callback, date='', poll_interval=0.5, stop=None):
+    """ Follow an R31 file and call *callback* with a pandas DataFrame of every batch of new measurements
+        (with 'ice_and_snow' column).
+        *calibration* is a Calibration object or a calibration csv file.
+        Returns False if the calibration could not be read.
+    """
+    if not isinstance(calibration, Calibration):
+        calibration = Calibration.from_csv(calibration)
+    if calibration is None:
+        return False
+    for chunk in follow_r31(inp_filename, date, poll_interval, stop):
+        callback(add_thickness(chunk, calibration, em_height))
+    return True
+
+
+async def queue_thickness(inp_filename, calibration, em_height, queue, date='', poll_interval=0.5, stop=None):
+    """ Asynchronous version of follow_thickness: every batch of new measurements is put into an asyncio *queue*.
+        The file is polled without blocking the event loop, a full queue makes the reader wait (backpressure).
+        Returns False if the calibration could not be read.
+    """
+    if not isinstance(calibration, Calibration):
+        calibration = Calibration.from_csv(calibration)
+    if calibration is None:
+        return False
+    for chunk in poll_r31(inp_filename, date, stop):
+        if chunk is None:
+            await asyncio.sleep(poll_interval)
+        else:
+            await queue.put(add_thickness(chunk, calibration, em_height))
+    return True
+
+
+def _print_ndjson(chunk):
+    print(to_ndjson(chunk))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    desc = """ Follow an R31 file that is being written by the EM-31 and print ice and snow thickness of every new
+               measurement as NDJSON (one JSON object per line) to stdout.
+               Arguments:
+               -i           input R31 file
+               -cal         calibration csv file
+               -em_height   height of the EM device above the snow surface
+               -d           date of the survey in the format %Y%m%d (optional)
+               -interval    polling interval in seconds (optional), default is 0.5
+           """
+    parser = argparse.ArgumentParser(description=desc.replace('%', '%%'))
+    parser.add_argument('-i', help='Input R31 file.')
+    parser.add_argument('-cal', help='Calibration csv file.')
+    parser.add_argument('-em_height', help='EM device height above the snow surface.')
+    parser.add_argument('-d', help='Date of the survey in the format %%Y%%m%%d.')
+    parser.add_argument('-interval', help='Polling interval in seconds.')
+    args = parser.parse_args()
+
+    """ Check mandatory arguments """
+    if not args.i:
+        print('Input file name should be specified with -i option.')
+        sys.exit()
+    if not args.cal:
+        print('Calibration csv file should be specified with -cal option.')
+        sys.exit()
+    if not args.em_height:
+        print('EM device hight above the snow surface should be specified with -em_height option.')
+        sys.exit()
+
+    interval = float(args.interval) if args.interval else 0.5
+    try:
+        res = follow_thickness(args.i, args.cal, float(args.em_height), _print_ndjson, args.d or '', interval)
+    except KeyboardInterrupt:
+        res = True
+    if not res:
+        print('Something went wrong while reading the calibration file. Check messages above.')
@@ -1,13 +1,70 @@
 """ PointMeasurement class definition.
 """
+import numpy as np
+import pandas as pd
+
 
 class PointMeasurement(object):
+    """ Single measurement: *data* value, *coordinates* (lat, lon) and *timestamp* of the measurement. """
+    __slots__ = ('data', 'coordinates', 'timestamp')
+
     def __init__(self, data, coordinates, timestamp):
         self.data = data
         self.coordinates = coordinates
         self.timestamp = timestamp
 
-    def location_at_time(self, timestamp):
+    def location_at_time(self, timestamp, floe):
         """ Calculate GPS coordinates of the measurement at the given time.
+            *floe* is a drift_station.IceFloe with reference point series covering both times.
+            Returns False if the floe has no reference data.
+        """
+        location = PointMeasurementSet([self.data], [self.coordinates[0]], [self.coordinates[1]],
+                                       [self.timestamp]).location_at_time(timestamp, floe)
+        if location is False:
+            return False
+        lat, lon = location
+        return lat[0], lon[0]
+
+
+class PointMeasurementSet(object):
+    """ Collection of point measurements stored as contiguous numpy columns:
+        data, lat, lon (degrees) and timestamp (datetime64).
+        Items are PointMeasurement objects created on request, all calculations are done on the columns.
+    """
+    def __init__(self, data, lat, lon, timestamp):
+        self.data = np.asarray(data)
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        self.timestamp = np.asarray(timestamp, dtype='datetime64[ns]')
+        if not (self.data.shape[0] == self.lat.size == self.lon.size == self.timestamp.size):
+            raise ValueError('All the columns are expected to have the same length.')
+
+    @classmethod
+    def from_dataframe(cls, df, data_column='ice_and_snow', lat_column='lat', lon_column='lon', time_column='time'):
+        """ Create a set from a pandas DataFrame with measurements. """
+        return cls(df[data_column].values, df[lat_column].values, df[lon_column].values, df[time_column].values)
+
+    def __len__(self):
+        return self.lat.size
+
+    def __getitem__(self, i):
+        return PointMeasurement(self.data[i], (self.lat[i], self.lon[i]), self.timestamp[i])
+
+    def to_dataframe(self):
+        return pd.DataFrame({'data': self.data, 'lat': self.lat, 'lon': self.lon, 'time': self.timestamp})
+
+    def local_coordinates(self, floe):
+        """ Floe-fixed coordinates x, y (metres) of all the measurements. """
+        return floe.global2local(self.lat, self.lon, self.timestamp)
+
+    def location_at_time(self, timestamp, floe):
+        """ GPS coordinates (lat, lon arrays) of all the measurements at the given reference time.
+            Every measurement is moved with the floe from the time it was taken to *timestamp*
+            (drift and rotation from the reference point series of *floe*, a drift_station.IceFloe).
+            Returns False if the floe has no reference data.
         """
-        pass
+        local = self.local_coordinates(floe)
+        if local is False:
+            return False
+        """ One transform at the reference time is applied to all the measurements. """
+        return floe.local2global(local[0], local[1], pd.Timestamp(timestamp).to_datetime64())
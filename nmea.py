@@ -0,0 +1,123 @@
+""" Batch decoding of NMEA (GPGGA) values.
+    All the functions work on whole arrays of strings at once:
+    times hhmmss.ss are converted into seconds of the day, days passed since the first fix are found from
+    the drops of the time of the day at midnight, and coordinates ddmm.mmmm with hemisphere letters
+    are converted into signed decimal degrees.
+    Large log files can be split into parts at record boundaries to be parsed in parallel.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+
+SECONDS_PER_DAY = 86400
+""" Time of the day dropping by more than half a day between consecutive fixes is a rollover to the next day,
+    smaller drops are fixes coming out of order.
+"""
+ROLLOVER_THRESHOLD = SECONDS_PER_DAY / 2
+
+
+def to_float(values):
+    """ Convert a sequence of strings to a float array, unreadable values are NaN. """
+    try:
+        return np.array(values, dtype=float)
+    except ValueError:
+        return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').values.astype(float)
+
+
+def decode_time(values):
+    """ Seconds of the day (float) for NMEA times hhmmss or hhmmss.ss, NaN for unreadable values. """
+    hhmmss = to_float(values)
+    return hhmmss // 10000 * 3600 + hhmmss // 100 % 100 * 60 + hhmmss % 100
+
+
+def day_rollover(seconds, previous=np.nan):
+    """ Number of midnights passed before every fix.
+        *seconds* are seconds of the day of consecutive fixes (NaN values are skipped),
+        *previous* is the time of the day of the last fix before them (e.g. from the previous block of a file).
+    """
+    seconds = pd.Series(np.concatenate([[previous], seconds])).ffill().values
+    with np.errstate(invalid='ignore'):
+        rollover = seconds[1:] < seconds[:-1] - ROLLOVER_THRESHOLD
+    return np.cumsum(rollover)
+
+
+def decode_coordinates(values, hemisphere):
+    """ Decimal degrees for NMEA coordinates ddmm.mmmm (latitude) or dddmm.mmmm (longitude).
+        *hemisphere* is a sequence of 'N', 'S', 'E', 'W' letters, southern and western coordinates are negative.
+    """
+    value = to_float(values)
+    degrees = np.trunc(value / 100.)
+    result = degrees + (value - degrees * 100.) / 60.
+    negative = np.isin(np.asarray(hemisphere, dtype=object), ['S', 'W', 's', 'w'])
+    return np.where(negative, -result, result)
+
+
+def to_datetime64(date, days, seconds):
+    """ datetime64[ns] array from the date (numpy.datetime64 or pandas.Timestamp), days after it,
+        and seconds of the day.
+    """
+    start = np.datetime64(pd.Timestamp(date).to_datetime64(), 'ns')
+    return start + (np.asarray(days, dtype=np.int64) * SECONDS_PER_DAY * 10 ** 9
+                    + np.round(np.asarray(seconds, dtype=float) * 1e9).astype(np.int64)).astype('timedelta64[ns]')
+
+
+def record_boundaries(inp_filename, n_parts, marker=b'\n@$GPGGA', search_size=2 ** 16):
+    """ Byte offsets splitting a log file into about *n_parts* parts, every part except the first one
+        starts with a GPGGA record, so no record is split and every part starts with a fix.
+        Returns a list of offsets starting with 0 and ending with the file size.
+    """
+    size = os.path.getsize(inp_filename)
+    offsets = [0]
+    with open(inp_filename, 'rb') as f:
+        for i in range(1, n_parts):
+            position = max(size * i // n_parts, offsets[-1])
+            f.seek(position)
+            """ Look for the marker in windows of *search_size* bytes, windows overlap by the marker length. """
+            while position < size:
+                window = f.read(search_size)
+                found = window.find(marker)
+                if found >= 0:
+                    position += found + 1
+                    break
+                if len(window) < search_size:
+                    position = size
+                    break
+                position += search_size - len(marker)
+                f.seek(position)
+            if offsets[-1] < position < size:
+                offsets.append(position)
+    offsets.append(size)
+    return offsets
+
+
+def parse_gga(lines):
+    """ Decode complete GPGGA sentences (one per line, e.g. from a GPS tracker).
+        Lines of other sentences and GPGGA records without a fix (quality 0) are skipped.
+        Returns arrays of seconds of the day, latitudes and longitudes (decimal degrees).
+    """
+    fields = [line.split(',') for line in lines if line[3:6] == 'GGA' and line.count(',') >= 6]
+    fields = [item for item in fields if item[6] not in ('', '0')]
+    if not fields:
+        return np.array([]), np.array([]), np.array([])
+    columns = list(zip(*fields))
+    return (decode_time(columns[1]),
+            decode_coordinates(columns[2], columns[3]),
+            decode_coordinates(columns[4], columns[5]))
+
+
+def format_gga(seconds, lat, lon, talker='GP'):
+    """ GPGGA sentence with checksum for the given time of the day and coordinates (decimal degrees).
+        Used to replay or simulate GPS trackers.
+    """
+    seconds = seconds % SECONDS_PER_DAY
+    lat_degrees, lon_degrees = int(abs(lat)), int(abs(lon))
+    body = '{0}GGA,{1:02d}{2:02d}{3:05.2f},{4:02d}{5:07.4f},{6},{7:03d}{8:07.4f},{9},1,08,0.9,10.0,M,,M,,'.format(
+        talker, int(seconds // 3600), int(seconds // 60 % 60), seconds % 60,
+        lat_degrees, (abs(lat) - lat_degrees) * 60, 'S' if lat < 0 else 'N',
+        lon_degrees, (abs(lon) - lon_degrees) * 60, 'W' if lon < 0 else 'E')
+    checksum = 0
+    for char in body:
+        checksum ^= ord(char)
+    return '${0}*{1:02X}'.format(body, checksum)
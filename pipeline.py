@@ -0,0 +1,196 @@
+""" Batch processing of EM-31 surveys.
+    Every R31 file is read, corrected for a uniform drift and converted into ice and snow thickness
+    in a pool of worker processes. Intermediate results are kept in memory, files from the same
+    directory (survey) are written into one consolidated output file.
+    A corrupt file does not stop the batch, it is listed in the report with the error message.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import profiling
+from estimate_thickness import Calibration, estimate_height
+from read_r31 import read_r31
+from survey_io import FORMATS, write_table
+from uniform_drift import correct_uniform_drift
+
+
+def find_r31_files(inp):
+    """ List R31 files in a directory (non-recursive) or matching a glob pattern. """
+    if os.path.isdir(inp):
+        files = [os.path.join(inp, item) for item in os.listdir(inp) if item.lower().endswith('.r31')]
+    else:
+        files = glob.glob(inp)
+    return sorted(files)
+
+
+def process_file(r31_file, calibration, em_height, date=''):
+    """ Run the processing chain for one R31 file.
+        *calibration* is a Calibration object or a calibration csv file.
+        Returns a pandas DataFrame with the results and a dictionary with the time spent on each stage.
+        Exceptions are raised if any of the stages fails.
+    """
+    timings = {}
+    start = time.perf_counter()
+    data = read_r31(r31_file, date)
+    timings['parse'] = time.perf_counter() - start
+    if data.shape[0] < 2:
+        raise ValueError('No measurements found in {0}.'.format(r31_file))
+
+    start = time.perf_counter()
+    if not correct_uniform_drift(data):
+        raise ValueError('Drift correction failed for {0}.'.format(r31_file))
+    timings['drift'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if not estimate_height(data, calibration, em_height):
+        raise ValueError('Thickness estimation failed for {0}.'.format(r31_file))
+    timings['thickness'] = time.perf_counter() - start
+
+    data['file'] = os.path.basename(r31_file)
+    return data, timings
+
+
+def _process_file(r31_file, calibration, em_height, date):
+    """ Worker function, errors are returned instead of being raised.
+        Profiling records of the worker process are returned as well.
+    """
+    start = time.perf_counter()
+    try:
+        data, timings = process_file(r31_file, calibration, em_height, date)
+        error = None
+    except Exception:
+        data, timings = None, {}
+        error = traceback.format_exc()
+    timings['total'] = time.perf_counter() - start
+    return r31_file, data, timings, error, profiling.collect()
+
+
+def survey_names(directories):
+    """ Output file names (without extension) for survey directories: the directory name,
+        or the path relative to the common parent joined with '_' if several directories have the same name.
+    """
+    directories = sorted(directories)
+    names = {item: os.path.basename(item) for item in directories}
+    if len(set(names.values())) < len(names):
+        """ Paths relative to the common parent, or to its parent if the common parent is a survey itself. """
+        parent = os.path.commonpath(directories)
+        if parent in names:
+            parent = os.path.dirname(parent)
+        names = {item: os.path.relpath(item, parent).replace(os.sep, '_') for item in directories}
+    return names
+
+
+def run_pipeline(files, calibration_csv, em_height, out_dir, date='', workers=None, out_format='.npz'):
+    """ Process R31 files in parallel and write one file per survey (input directory) into *out_dir*
+        (see survey_names),
+        *out_format* is '.npz', '.parquet', or '.csv'.
+        The calibration is fitted once and sent to the worker processes.
+        Returns the report: a list of dictionaries with file name, number of rows, timings and error message,
+        or False if the calibration could not be read.
+    """
+    if isinstance(calibration_csv, Calibration):
+        calibration = calibration_csv
+    else:
+        calibration = Calibration.from_csv(calibration_csv)
+    if calibration is None:
+        return False
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    results = {}
+    report = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_process_file, item, calibration, em_height, date) for item in files]
+        for i, future in enumerate(as_completed(futures)):
+            r31_file, data, timings, error, records = future.result()
+            profiling.records.extend(records)
+            rows = 0 if data is None else data.shape[0]
+            report.append({'file': r31_file, 'rows': rows, 'timings': timings, 'error': error})
+            if error:
+                print('[{0}/{1}] {2} failed: {3}'.format(i + 1, len(files), r31_file, error.strip().splitlines()[-1]))
+            else:
+                results[r31_file] = data
+                print('[{0}/{1}] {2}: {3} rows in {4:.2f} s'.format(i + 1, len(files), r31_file, rows, timings['total']))
+
+    surveys = {}
+    for r31_file in sorted(results):
+        surveys.setdefault(os.path.dirname(os.path.abspath(r31_file)), []).append(results[r31_file])
+    names = survey_names(surveys)
+    for survey, frames in surveys.items():
+        write_table(pd.concat(frames, ignore_index=True), os.path.join(out_dir, names[survey] + out_format))
+
+    report.sort(key=lambda item: item['file'])
+    with open(os.path.join(out_dir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    desc = """ Process all R31 files of one or several surveys: read, correct uniform drift and estimate
+               ice and snow thickness.
+               Arguments:
+               -i           input directory or glob pattern (quoted), e.g. "data/*/*.R31"
+               -o           output directory
+               -cal         calibration csv file
+               -em_height   height of the EM device above the snow surface
+               -d           date of the survey in the format %Y%m%d (optional)
+               -j           number of worker processes (optional), default is the number of CPUs
+               -format      output format: npz (default), parquet, or csv
+               -profile     save profiling report to a json file (optional), default is em31_profile.json
+            Results are written into one file per input directory, report.json contains timings and errors.
+           """
+    parser = argparse.ArgumentParser(description=desc.replace('%', '%%'))
+    parser.add_argument('-i', help='Input directory or glob pattern.')
+    parser.add_argument('-o', help='Output directory.')
+    parser.add_argument('-cal', help='Calibration csv file.')
+    parser.add_argument('-em_height', help='EM device height above the snow surface.')
+    parser.add_argument('-d', help='Date of the survey in the format %%Y%%m%%d.')
+    parser.add_argument('-j', help='Number of worker processes.')
+    parser.add_argument('-format', help='Output format: npz, parquet, or csv.')
+    parser.add_argument('-profile', nargs='?', const=profiling.DEFAULT_REPORT, help='Save profiling report to a json file.')
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable(args.profile)
+
+    """ Check mandatory arguments """
+    if not args.i:
+        print('Input directory or glob pattern should be specified with -i option.')
+        sys.exit()
+    if not args.o:
+        print('Output directory should be specified with -o option.')
+        sys.exit()
+    if not args.cal:
+        print('Calibration csv file should be specified with -cal option.')
+        sys.exit()
+    if not args.em_height:
+        print('EM device hight above the snow surface should be specified with -em_height option.')
+        sys.exit()
+
+    files = find_r31_files(args.i)
+    if not files:
+        print('No R31 files found for {0}.'.format(args.i))
+        sys.exit()
+
+    out_format = '.' + (args.format or 'npz').lstrip('.').lower()
+    if out_format not in FORMATS:
+        print('Unknown output format {0}, possible values are npz, parquet, and csv.'.format(args.format))
+        sys.exit()
+
+    start = time.perf_counter()
+    report = run_pipeline(files, args.cal, float(args.em_height), args.o, args.d or '', int(args.j) if args.j else None,
+                          out_format)
+    if report is False:
+        print('Something went wrong while reading the calibration file. Check messages above.')
+        sys.exit()
+    failed = [item['file'] for item in report if item['error']]
+    print('Processed {0} files in {1:.1f} s, {2} failed.'.format(len(files), time.perf_counter() - start, len(failed)))
+    for item in failed:
+        print('    {0}'.format(item))
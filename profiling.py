@@ -0,0 +1,136 @@
+""" Opt-in instrumentation of the processing chain.
+    Functions decorated with @profiled record wall time, number of rows processed, rows per second,
+    and the change of the resident memory of the process for every call.
+    Instrumentation is off by default and costs one check per call. It is enabled with EM31_PROFILE environment
+    variable (1, or the name of the json report file) or with -profile option of the command line scripts.
+    At the end of the run the records are saved into a json report (em31_profile.json by default)
+    and a summary per function is printed.
+"""
+import atexit
+import functools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+DEFAULT_REPORT = 'em31_profile.json'
+ENABLED = False
+REPORT_FILE = None
+records = []
+_depth = 0
+
+
+def enable(report_file=DEFAULT_REPORT):
+    """ Turn the instrumentation on and save the report into *report_file* at exit.
+        The environment variable is set as well, so worker processes are instrumented too.
+    """
+    global ENABLED, REPORT_FILE
+    if not ENABLED:
+        atexit.register(_at_exit)
+    ENABLED = True
+    REPORT_FILE = report_file
+    os.environ['EM31_PROFILE'] = report_file
+
+
+def _memory():
+    """ Resident memory of the process in bytes (peak resident memory where /proc is not available). """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, IOError, ValueError, AttributeError):
+        if resource is None:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _rows(result, args):
+    """ Number of rows processed: length of the returned table, or of the input table for functions
+        that modify a DataFrame in place and return True/False.
+    """
+    for item in [result] + list(args[:1]):
+        if isinstance(item, tuple) and item:
+            item = item[0]
+        if isinstance(item, (pd.DataFrame, pd.Series, np.ndarray)) and item.ndim:
+            return int(item.shape[0])
+    return None
+
+
+def profiled(func):
+    """ Decorator recording a profiling record for every call of *func* when the instrumentation is enabled. """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        global _depth
+        if not ENABLED:
+            return func(*args, **kwargs)
+        memory = _memory()
+        _depth += 1
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            _depth -= 1
+        rows = _rows(result, args)
+        records.append({'function': func.__name__,
+                        'depth': _depth,
+                        'pid': os.getpid(),
+                        'seconds': seconds,
+                        'rows': rows,
+                        'rows_per_second': rows / seconds if rows is not None and seconds > 0 else None,
+                        'memory_delta_mb': (_memory() - memory) / 2. ** 20,
+                        })
+        return result
+    return wrapper
+
+
+def collect():
+    """ Return and clear the records of this process (used to send records from worker processes). """
+    result = records[:]
+    del records[:]
+    return result
+
+
+def summary(items=None):
+    """ Human-readable summary: calls, total time, rows, and throughput per function. """
+    items = records if items is None else items
+    functions = []
+    for item in items:
+        if item['function'] not in functions:
+            functions.append(item['function'])
+    lines = ['{0:<24}{1:>7}{2:>12}{3:>12}{4:>14}{5:>12}'.format('function', 'calls', 'seconds', 'rows', 'rows/s', 'memory MB')]
+    for function in functions:
+        calls = [item for item in items if item['function'] == function]
+        seconds = sum(item['seconds'] for item in calls)
+        rows = sum(item['rows'] or 0 for item in calls)
+        memory = sum(item['memory_delta_mb'] for item in calls)
+        lines.append('{0:<24}{1:>7}{2:>12.4f}{3:>12}{4:>14.0f}{5:>12.1f}'.format(
+            function, len(calls), seconds, rows, rows / seconds if seconds > 0 else 0, memory))
+    return '\n'.join(lines)
+
+
+def save_report(report_file, items=None):
+    items = records if items is None else items
+    with open(report_file, 'w') as f:
+        json.dump({'records': items}, f, indent=2)
+
+
+def _at_exit():
+    """ Worker processes do not write reports, their records are collected by the parent process. """
+    if not records or multiprocessing.parent_process() is not None:
+        return
+    save_report(REPORT_FILE)
+    sys.stderr.write('Profiling report is saved to {0}.\n{1}\n'.format(REPORT_FILE, summary()))
+
+
+if os.environ.get('EM31_PROFILE'):
+    enable(os.environ['EM31_PROFILE'] if os.environ['EM31_PROFILE'].endswith('.json') else DEFAULT_REPORT)
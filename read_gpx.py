@@ -3,27 +3,116 @@
 """
 import argparse
 import sys
+import warnings
 
+import numpy as np
 import pandas as pd
-import datetime
 from xml.etree import ElementTree
 
+from profiling import DEFAULT_REPORT, enable as enable_profiling, profiled
+from survey_cache import cached_read
+from survey_io import write_table
 
-def read_gpx(inp_file, time_format='%Y-%m-%dT%H:%M:%SZ'):
-    gpx = ElementTree.parse(inp_file).getroot()
-    coords = [{'lat': float(point.get('lat')),
-               'lon': float(point.get('lon')),
-               'time': datetime.datetime.strptime(point[1].text, time_format),
-               'elevation': float(point[0].text)} for point in gpx[1][4]]
-    data = pd.DataFrame(coords)
-    return data
+
+BATCH_SIZE = 100000
+ISO_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+@profiled
+def read_gpx(inp_file, time_format=ISO_TIME_FORMAT, batch_size=BATCH_SIZE):
+    """ Read all track points of a .gpx file into a pandas DataFrame with the following columns:
+        'lat', 'lon', 'time', 'elevation', 'track', 'segment'.
+        Tracks and segments are numbered from 0 in the order of the file.
+        The file is parsed with iterparse, processed points are removed from the tree,
+        timestamps are converted in batches of *batch_size* points.
+    """
+    batches = []
+    lat, lon, time, elevation, track, segment = [], [], [], [], [], []
+    track_id = -1
+    segment_id = -1
+    point_time = None
+    point_elevation = np.nan
+    container = None
+    names = {}
+
+    for event, elem in ElementTree.iterparse(inp_file, events=('start', 'end')):
+        """ Tag name without the XML namespace. """
+        name = names.get(elem.tag)
+        if name is None:
+            name = names.setdefault(elem.tag, elem.tag.rsplit('}', 1)[-1])
+        if event == 'start':
+            if name == 'trk':
+                track_id += 1
+                segment_id = -1
+            elif name == 'trkseg':
+                segment_id += 1
+                container = elem
+            continue
+
+        if name == 'trkpt':
+            lat.append(elem.get('lat'))
+            lon.append(elem.get('lon'))
+            time.append(point_time)
+            elevation.append(point_elevation)
+            track.append(track_id)
+            segment.append(segment_id)
+            point_time = None
+            point_elevation = np.nan
+            """ Processed points are not needed anymore. """
+            if container is not None:
+                container.clear()
+            if len(lat) >= batch_size:
+                batches.append(_batch(lat, lon, time, elevation, track, segment, time_format))
+                lat, lon, time, elevation, track, segment = [], [], [], [], [], []
+        elif name == 'time' and container is not None:
+            point_time = elem.text
+        elif name == 'ele' and container is not None:
+            point_elevation = elem.text
+        elif name == 'trkseg':
+            container = None
+        elif name == 'trk':
+            elem.clear()
+
+    batches.append(_batch(lat, lon, time, elevation, track, segment, time_format))
+    return pd.concat(batches, ignore_index=True)
+
+
+def _batch(lat, lon, time, elevation, track, segment, time_format):
+    return pd.DataFrame({'lat': np.array(lat, dtype=float),
+                         'lon': np.array(lon, dtype=float),
+                         'time': parse_time(time, time_format),
+                         'elevation': pd.to_numeric(pd.Series(elevation, dtype=object), errors='coerce'),
+                         'track': np.array(track, dtype=np.int64),
+                         'segment': np.array(segment, dtype=np.int64),
+                         })
+
+
+def parse_time(time, time_format=ISO_TIME_FORMAT):
+    """ Convert a sequence of time strings to datetime64, ISO 8601 strings are converted by numpy directly.
+        Missing times (None) are converted to NaT.
+    """
+    if time_format == ISO_TIME_FORMAT:
+        try:
+            with warnings.catch_warnings():
+                """ numpy only warns about UTC offsets. """
+                warnings.simplefilter('error')
+                return np.array(['NaT' if item is None else item.rstrip('Z') for item in time], dtype='datetime64[ns]')
+        except (ValueError, UserWarning):
+            """ Other ISO 8601 forms, e.g. with UTC offsets, are converted to UTC by pandas. """
+            result = pd.to_datetime(pd.Series(time, dtype=object), format='ISO8601', utc=True, errors='coerce')
+            return result.dt.tz_localize(None).values.astype('datetime64[ns]')
+    return pd.to_datetime(pd.Series(time, dtype=object), format=time_format, errors='coerce').values
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Convert *.gpx files created by GPS navigators into *.csv files. Input and output files should be specified with -i and -o options.')
+    parser = argparse.ArgumentParser(description='Convert *.gpx files created by GPS navigators into tables (.npz, .parquet, or .csv by the extension of the output file). Input and output files should be specified with -i and -o options.')
     parser.add_argument('-i', help='input filename')
-    parser.add_argument('-o', help='output filename')
+    parser.add_argument('-o', help='output filename (.npz, .parquet, or .csv)')
+    parser.add_argument('-cache', help='directory for cached parsed files (optional)')
+    parser.add_argument('-profile', nargs='?', const=DEFAULT_REPORT, help='save profiling report to a json file (optional)')
     args = parser.parse_args()
+    if args.profile:
+        enable_profiling(args.profile)
 
     """ Check mandatory arguments """
     if not args.i:
@@ -32,5 +121,8 @@ if __name__ == '__main__':
     if not args.o:
         print('Please, specify output file with -o option.')
 
-    data = read_gpx(args.i)
-    data.to_csv(args.o)
+    if args.cache:
+        data = cached_read(read_gpx, args.i, cache_dir=args.cache)
+    else:
+        data = read_gpx(args.i)
+    write_table(data, args.o)
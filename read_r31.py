@@ -1,66 +1,255 @@
 """ Script for reading EM-31 log files (*.R31) and convertion into a csv file
 """
 
-import datetime as dtm
 import argparse
+import re
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress
 
+import numpy as np
 import pandas as pd
 
+from nmea import (ROLLOVER_THRESHOLD, SECONDS_PER_DAY, day_rollover, decode_coordinates, decode_time,
+                  record_boundaries, to_datetime64, to_float)
+from profiling import DEFAULT_REPORT, enable as enable_profiling, profiled
+from survey_cache import cached_read
+from survey_io import write_table
 
-def read_r31(inp_filename, date=''):
+
+""" A GPGGA record is split over two lines of the R31 log:
+    the first line ends with the beginning of the latitude string,
+    the second line starts with a marker character, the rest of the latitude, hemisphere, longitude and hemisphere.
+    Both GPGGA and data records are matched by one pattern, so the matches come in the order of the file.
+"""
+RECORD_PATTERN = re.compile(r'(@\$GPGGA),([^,\n]*),(?:[^\n]*,)?([^,\n]*)\n.([^,\n]*),([^,\n]*),([^,\n]*),?([^,\n]*)'
+                            r'|^(?=[^\n]*data:)[^-\n]*-([^-+\n]*)', re.MULTILINE)
+BLOCK_SIZE = 2 ** 20
+""" Files smaller than this are always parsed in one process. """
+PARALLEL_MIN_SIZE = 2 ** 26
+
+
+class R31Parser(object):
+    """ Incremental parser for the text of R31 log files.
+        Text is fed in blocks of arbitrary size with *feed*, every call returns a pandas DataFrame
+        with the measurements completed by the new text. The last fix (time, lat, lon) and the number of days
+        passed since the first fix are kept between the calls, so a GPGGA record split between two blocks
+        and surveys crossing midnight UTC are handled correctly.
+        *close* should be called after the last block to process the remaining text.
+    """
+    def __init__(self, date=''):
+        self.date = pd.Timestamp(date) if date else pd.Timestamp('1900-01-01')
+        self.tail = ''
+        self.lat = np.nan
+        self.lon = np.nan
+        self.seconds = np.nan
+        self.days = 0
+
+    def feed(self, text):
+        text = self.tail + text
+        end = text.rfind('\n') + 1
+        if not end:
+            self.tail = text
+            return self._empty()
+        """ If the last complete line is the first half of a GPGGA record, it is kept for the next call. """
+        cut = text.rfind('\n', 0, end - 1) + 1
+        if '@$GPGGA' in text[cut:end]:
+            end = cut
+        self.tail = text[end:]
+        return self._parse(text, end)
+
+    def close(self):
+        text = self.tail
+        self.tail = ''
+        if text and not text.endswith('\n'):
+            text += '\n'
+        return self._parse(text, len(text))
+
+    def _parse(self, text, end):
+        """ Parse records in text[:end]. """
+        records = RECORD_PATTERN.findall(text, 0, end)
+        if not records:
+            return self._empty()
+        columns = list(zip(*records))
+        is_fix = np.array(columns[0], dtype=bool)
+        fix_columns = [list(compress(column, is_fix)) for column in columns[1:7]]
+
+        """ Fixes: seconds of the day and coordinates, a fix with an unreadable latitude only updates time. """
+        seconds = decode_time(fix_columns[0])
+        lat = decode_coordinates([a + b for a, b in zip(fix_columns[1], fix_columns[2])], fix_columns[3])
+        lon = decode_coordinates(fix_columns[4], fix_columns[5])
+        lon[np.isnan(lat)] = np.nan
+        days = self.days + day_rollover(seconds, self.seconds)
+
+        """ Prepend the last fix of the previous block and forward fill the missing values. """
+        fix_seconds = pd.Series(np.concatenate([[self.seconds], seconds])).ffill().values
+        fix_days = np.concatenate([[self.days], days])
+        fix_lat = pd.Series(np.concatenate([[self.lat], lat])).ffill().values
+        fix_lon = pd.Series(np.concatenate([[self.lon], lon])).ffill().values
+        self.seconds, self.days, self.lat, self.lon = fix_seconds[-1], fix_days[-1], fix_lat[-1], fix_lon[-1]
+
+        """ Every data record takes the last fix preceding it. """
+        fix_index = np.cumsum(is_fix)[~is_fix]
+        df = pd.DataFrame({'lat': fix_lat[fix_index],
+                           'lon': fix_lon[fix_index],
+                           'data': to_float(list(compress(columns[7], ~is_fix))) / 4.,
+                           'timestamp': fix_days[fix_index] * SECONDS_PER_DAY + fix_seconds[fix_index],
+                           })
+        df = df[(df.lat != 0) & (df.lon != 0)].dropna()
+        df['time'] = to_datetime64(self.date, 0, df.timestamp.values)
+        df['timestamp'] = np.floor(df.timestamp).astype(np.int64)
+        return df.reset_index(drop=True)
+
+    def _empty(self):
+        return pd.DataFrame({'lat': np.array([], dtype=float),
+                             'lon': np.array([], dtype=float),
+                             'data': np.array([], dtype=float),
+                             'timestamp': np.array([], dtype=np.int64),
+                             'time': np.array([], dtype='datetime64[ns]'),
+                             })
+
+
+def read_r31_chunks(inp_filename, date='', block_size=BLOCK_SIZE):
+    """ Generator of pandas DataFrames with measurements from an R31 file.
+        The file is read in blocks of *block_size* characters, so memory use does not depend on the file size.
+        Every DataFrame has the following columns: 'lat', 'lon', 'data', 'timestamp', 'time'.
+    """
+    parser = R31Parser(date)
+    with open(inp_filename, 'r') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            chunk = parser.feed(block)
+            if chunk.shape[0]:
+                yield chunk
+    chunk = parser.close()
+    if chunk.shape[0]:
+        yield chunk
+
+
+def _read_part(inp_filename, start, end, date):
+    """ Parse bytes [start, end) of an R31 file, days are counted from the first fix of the part. """
+    with open(inp_filename, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode(errors='replace')
+    """ Line breaks are translated as in the text mode used by the serial reader (CRLF logs). """
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    parser = R31Parser(date)
+    chunks = [parser.feed(text), parser.close()]
+    return pd.concat(chunks, ignore_index=True)
+
+
+def _join_parts(parts):
+    """ Concatenate DataFrames of consecutive parts of a file parsed independently and shift their
+        timestamps by the days passed before every part.
+    """
+    parts = [item for item in parts if item.shape[0]]
+    offset = 0
+    last = None
+    for item in parts:
+        if last is not None:
+            offset += last // SECONDS_PER_DAY * SECONDS_PER_DAY
+            if item.timestamp.iloc[0] < last % SECONDS_PER_DAY - ROLLOVER_THRESHOLD:
+                offset += SECONDS_PER_DAY
+        last = item.timestamp.iloc[-1]
+        if offset:
+            item['timestamp'] += offset
+            item['time'] += np.timedelta64(offset, 's')
+    return pd.concat(parts, ignore_index=True)
+
+
+@profiled
+def read_r31(inp_filename, date='', block_size=BLOCK_SIZE, workers=1):
+    """ Read an R31 file into a pandas DataFrame with the following columns:
+        'lat', 'lon', 'data', 'timestamp', 'time'.
+        *date* is the date of the survey in the format %Y%m%d.
+        'timestamp' is the number of seconds since the start of the survey date, it keeps growing after midnight.
+        Files larger than PARALLEL_MIN_SIZE are split at GPGGA records and parsed by *workers* processes.
+    """
+    if workers > 1:
+        offsets = record_boundaries(inp_filename, workers)
+        if offsets[-1] >= PARALLEL_MIN_SIZE and len(offsets) > 2:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                parts = list(executor.map(_read_part, [inp_filename] * (len(offsets) - 1), offsets[:-1], offsets[1:],
+                                          [date] * (len(offsets) - 1)))
+            if not any(item.shape[0] for item in parts):
+                return R31Parser()._empty()
+            data = _join_parts(parts)
+            if date:
+                data.attrs['survey_date'] = date
+            return data
+    chunks = list(read_r31_chunks(inp_filename, date, block_size))
+    if not chunks:
+        return R31Parser()._empty()
+    data = pd.concat(chunks, ignore_index=True)
     if date:
-        timeformat = '%Y%m%d%H%M%S.00'
-    else:
-        timeformat = '%H%M%S.00'
+        data.attrs['survey_date'] = date
+    return data
+
+
+def read_available(f, parser, block_size=BLOCK_SIZE):
+    """ Read all text currently available in an open R31 file and parse it.
+        Returns a pandas DataFrame with the new measurements (may be empty).
+    """
+    chunks = []
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        chunk = parser.feed(block)
+        if chunk.shape[0]:
+            chunks.append(chunk)
+    if not chunks:
+        return parser._empty()
+    return pd.concat(chunks, ignore_index=True)
 
+
+def poll_r31(inp_filename, date='', stop=None):
+    """ Generator of pandas DataFrames with new measurements from an R31 file that is still being written,
+        None is yielded when all the available text is read and the caller should wait before the next poll.
+        The parser state (last GPS fix, incomplete lines) is kept between the polls.
+        *stop()* is checked before reading, so lines written before it returns True are read as well.
+    """
+    parser = R31Parser(date)
     with open(inp_filename, 'r') as f:
-        d = f.readlines()
-
-    preprocessed_data = []
-    lat = None
-    lon = None
-    timestamp = None
-    for i, line in enumerate(d):
-        if '@$GPGGA' in line:
-            time = dtm.datetime.strptime(date + line.split(',')[1], timeformat)
-            timestamp = dtm.timedelta(hours=time.hour, minutes=time.minute, seconds=time.second).seconds
-            lat1 = line.split(',')[-1]
-            lat2 = d[i + 1].split(',')[0]
-            lat_str = lat1[:-1] + lat2[1:]
-            try:
-                lat = float(lat_str) / 100.
-            except:
-                continue
-                pass
-            try:
-                lon = d[i + 1].split(',')[2]
-            except:
-                pass
-            lon = float(lon) / 100.
-            
-        if 'data:' in line and lat and lon:
-            datavalue = line.split('-')[1]
-            if '+' in datavalue:
-                datavalue = datavalue.split('+')[0]
-    
-            preprocessed_data.append({'lat': lat,
-                                      'lon': lon,
-                                      'data': int(datavalue) / 4.,
-                                      'timestamp': timestamp,
-                                      'time': time,
-                                      })
-    
-    q = pd.DataFrame(preprocessed_data)
-    return q
+        while True:
+            stopped = stop is not None and stop()
+            chunk = read_available(f, parser)
+            if chunk.shape[0]:
+                yield chunk
+            if stopped:
+                break
+            yield None
+    chunk = parser.close()
+    if chunk.shape[0]:
+        yield chunk
+
+
+def follow_r31(inp_filename, date='', poll_interval=0.5, stop=None):
+    """ Generator of pandas DataFrames with new measurements from an R31 file that is still being written.
+        The file is polled every *poll_interval* seconds (see poll_r31).
+        Stops when *stop()* returns True (never by default).
+    """
+    for chunk in poll_r31(inp_filename, date, stop):
+        if chunk is None:
+            time.sleep(poll_interval)
+        else:
+            yield chunk
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Convert *.R31 file from EM-31 into a csv. Input and output files should be provided with -i and -o options.')
+    parser = argparse.ArgumentParser(description='Convert *.R31 file from EM-31 into a table (.npz, .parquet, or .csv by the extension of the output file). Input and output files should be provided with -i and -o options.')
     parser.add_argument('-i', help='input filename')
-    parser.add_argument('-o', help='output filename')
-    parser.add_argument('-d', help='date in the format %Y%m%d.')
+    parser.add_argument('-o', help='output filename (.npz, .parquet, or .csv)')
+    parser.add_argument('-d', help='date in the format %%Y%%m%%d.')
+    parser.add_argument('-cache', help='directory for cached parsed files (optional)')
+    parser.add_argument('-j', help='number of worker processes for large files (optional), default is 1')
+    parser.add_argument('-profile', nargs='?', const=DEFAULT_REPORT, help='save profiling report to a json file (optional)')
     args = parser.parse_args()
+    if args.profile:
+        enable_profiling(args.profile)
 
     """ Check mandatory arguments """
     if not args.o:
@@ -71,9 +260,11 @@ if __name__ == '__main__':
         sys.exit()
 
     """ Set optional arguments """
-    if args.d:
-        data = read_r31(args.i, args.d)
+    date = args.d if args.d else ''
+    workers = int(args.j) if args.j else 1
+    if args.cache:
+        data = cached_read(read_r31, args.i, date, workers=workers, cache_dir=args.cache)
     else:
-        data = read_r31(args.i)
+        data = read_r31(args.i, date, workers=workers)
 
-    data.to_csv(args.o)
+    write_table(data, args.o)
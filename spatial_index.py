@@ -0,0 +1,86 @@
+""" Grid-bucket spatial index for neighbour search on projected coordinates (metres).
+    Points are sorted by the id of the square cell they fall into, so all the points within a given
+    distance from a query point are found by looking into the neighbouring cells only.
+    Queries are vectorized: many query points are processed at once.
+"""
+import numpy as np
+
+
+class GridIndex(object):
+    """ Spatial index of points (x, y) with square cells of *cell_size* metres.
+        The cell size should be close to the typical search radius.
+    """
+    def __init__(self, x, y, cell_size):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.cell_size = float(cell_size)
+        """ Points with NaN coordinates are not indexed. """
+        finite = np.flatnonzero(np.isfinite(self.x) & np.isfinite(self.y))
+        self.x_min = self.x[finite].min() if finite.size else 0.
+        self.y_min = self.y[finite].min() if finite.size else 0.
+        ix, iy = self._cells(self.x[finite], self.y[finite])
+        self.n_rows = int(iy.max()) + 3 if iy.size else 3
+        key = ix * self.n_rows + iy
+        order = np.argsort(key, kind='stable')
+        self.order = finite[order]
+        self.keys = key[order]
+
+    def _cells(self, x, y):
+        with np.errstate(invalid='ignore'):
+            ix = np.nan_to_num(np.floor((x - self.x_min) / self.cell_size), nan=-1).astype(np.int64) + 1
+            iy = np.nan_to_num(np.floor((y - self.y_min) / self.cell_size), nan=-1).astype(np.int64) + 1
+        return ix, iy
+
+    def query_pairs(self, qx, qy, radius, chunk_size=100000):
+        """ All pairs (query index, point index) with distance not larger than *radius*.
+            Returns three arrays: query indices, point indices, and distances.
+        """
+        qx = np.asarray(qx, dtype=float)
+        qy = np.asarray(qy, dtype=float)
+        n_cells = int(np.ceil(radius / self.cell_size))
+        offsets = np.arange(-n_cells, n_cells + 1)
+        result = [[], [], []]
+        for start in range(0, qx.size, chunk_size):
+            cx = qx[start:start + chunk_size]
+            cy = qy[start:start + chunk_size]
+            ix, iy = self._cells(cx, cy)
+            finite = np.isfinite(cx) & np.isfinite(cy)
+            for dx in offsets:
+                for dy in offsets:
+                    row = iy + dy
+                    valid = finite & (row >= 0) & (row < self.n_rows)
+                    key = (ix + dx) * self.n_rows + row
+                    lo = np.searchsorted(self.keys, key, side='left')
+                    hi = np.searchsorted(self.keys, key, side='right')
+                    count = np.where(valid, hi - lo, 0)
+                    total = count.sum()
+                    if not total:
+                        continue
+                    """ Expand [lo, hi) ranges into flat arrays of query and point indices. """
+                    query = np.repeat(np.arange(cx.size), count)
+                    position = np.arange(total) - np.repeat(np.cumsum(count) - count, count) + lo[query]
+                    point = self.order[position]
+                    distance = np.hypot(self.x[point] - cx[query], self.y[point] - cy[query])
+                    close = distance <= radius
+                    result[0].append(query[close] + start)
+                    result[1].append(point[close])
+                    result[2].append(distance[close])
+        if not result[0]:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=float)
+        return np.concatenate(result[0]), np.concatenate(result[1]), np.concatenate(result[2])
+
+    def nearest(self, qx, qy, max_distance):
+        """ Index of and distance to the nearest point within *max_distance* for every query point.
+            The index is -1 and the distance is inf where there are no points within *max_distance*.
+        """
+        qx = np.asarray(qx, dtype=float)
+        query, point, distance = self.query_pairs(qx, qy, max_distance)
+        index = np.full(qx.size, -1, dtype=np.int64)
+        best = np.full(qx.size, np.inf)
+        if query.size:
+            order = np.lexsort((distance, query))
+            query, point, distance = query[order], point[order], distance[order]
+            first = np.concatenate([[True], query[1:] != query[:-1]])
+            index[query[first]] = point[first]
+            best[query[first]] = distance[first]
+        return index, best
@@ -0,0 +1,110 @@
+""" On-disk cache for parsed survey files (*.R31, *.gpx, *.csv).
+    Every parsed DataFrame is stored as a set of .npy files (one per column) and loaded with copy-on-write
+    memory mapping, so repeated runs over the same survey skip the text parsing.
+    A cache entry is valid while the path, size and modification time of the source file do not change.
+    Total size of the cache directory is limited, least recently used entries are removed first.
+"""
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+
+CACHE_DIR = os.environ.get('EM31_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'em31'))
+MAX_CACHE_SIZE = 2 * 2 ** 30
+""" Part of the cache key, increased when the output of the readers changes, so old entries are not used. """
+READER_VERSION = 3
+
+
+def cached_read(reader, inp_filename, *args, cache_dir=None, max_size=MAX_CACHE_SIZE, **kwargs):
+    """ Return reader(inp_filename, *args, **kwargs) from the cache if possible.
+        *reader* is expected to return a pandas DataFrame (read_r31, read_gpx, pandas.read_csv, ...).
+        On a cache miss the file is parsed and the result is stored in *cache_dir*.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    source = os.path.abspath(inp_filename)
+    stat = os.stat(source)
+    key = '{0}.{1}({2}, {3}, {4}) v{5}'.format(reader.__module__, reader.__name__, source, args, sorted(kwargs.items()), READER_VERSION)
+    entry = os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    meta = _read_meta(entry)
+    if meta and meta['size'] == stat.st_size and meta['mtime'] == stat.st_mtime_ns:
+        os.utime(os.path.join(entry, 'meta.json'))
+        return _load(entry, meta)
+    if meta:
+        """ The source file has changed since the entry was written. """
+        shutil.rmtree(entry, ignore_errors=True)
+
+    df = reader(inp_filename, *args, **kwargs)
+    _store(df, entry, {'source': source, 'size': stat.st_size, 'mtime': stat.st_mtime_ns})
+    evict(cache_dir, max_size)
+    return df
+
+
+def evict(cache_dir=None, max_size=MAX_CACHE_SIZE):
+    """ Remove least recently used entries until the cache directory is smaller than *max_size* bytes. """
+    cache_dir = cache_dir or CACHE_DIR
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        meta_file = os.path.join(entry, 'meta.json')
+        if not os.path.isfile(meta_file):
+            continue
+        size = sum(os.path.getsize(os.path.join(entry, item)) for item in os.listdir(entry))
+        entries.append((os.path.getmtime(meta_file), size, entry))
+    total = sum(item[1] for item in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_size:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def clear(cache_dir=None):
+    """ Remove all cache entries. """
+    shutil.rmtree(cache_dir or CACHE_DIR, ignore_errors=True)
+
+
+def _read_meta(entry):
+    try:
+        with open(os.path.join(entry, 'meta.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _store(df, entry, meta):
+    """ Write the DataFrame columns into a temporary directory and move it in place. """
+    tmp = '{0}.{1}.tmp'.format(entry, os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    meta['columns'] = [str(column) for column in df.columns]
+    meta['attrs'] = df.attrs
+    for i, column in enumerate(df.columns):
+        values = df[column].values
+        if values.dtype == object:
+            values = values.astype(str)
+        np.save(os.path.join(tmp, '{0}.npy'.format(i)), np.asarray(values), allow_pickle=False)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f, default=str)
+    shutil.rmtree(entry, ignore_errors=True)
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        """ Another process has written the same entry. """
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _load(entry, meta):
+    """ Copy-on-write mapping: the frame can be edited in place, changes are not written to the cache. """
+    columns = {column: np.load(os.path.join(entry, '{0}.npy'.format(i)), mmap_mode='c')
+               for i, column in enumerate(meta['columns'])}
+    df = pd.DataFrame(columns, copy=False)
+    """ Metadata such as the survey date, entries written by older versions have none. """
+    df.attrs.update(meta.get('attrs', {}))
+    return df
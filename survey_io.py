@@ -0,0 +1,77 @@
+""" Reading and writing of tables (pandas DataFrames) passed between the scripts.
+    The format is chosen by the file extension:
+        .npz        numpy archive with one typed array per column and the schema (column names, dtypes,
+                    and metadata such as the survey date) stored as json, no text parsing on reading;
+        .parquet    Parquet file (requires pyarrow or fastparquet), metadata is stored in the file;
+        .csv        text, kept for export to other software. Time columns are parsed on reading,
+                    index column written by older versions of the scripts is dropped.
+    Metadata is taken from and restored into DataFrame.attrs.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+FORMATS = ['.npz', '.parquet', '.csv']
+TIME_COLUMNS = ['time', 'time_corr']
+
+
+def table_format(path):
+    """ Format of a table file: '.npz', '.parquet', or '.csv' (for any other extension). """
+    extension = os.path.splitext(path)[1].lower()
+    return extension if extension in FORMATS else '.csv'
+
+
+def write_table(df, path, meta=None):
+    """ Write a pandas DataFrame to *path* in the format given by the extension.
+        *meta* is a dictionary with metadata (json serializable), DataFrame.attrs are used by default.
+        The index is not written.
+    """
+    meta = dict(df.attrs if meta is None else meta)
+    form = table_format(path)
+    if form == '.csv':
+        df.to_csv(path, index=False)
+    elif form == '.parquet':
+        df = df.reset_index(drop=True)
+        df.attrs = meta
+        df.to_parquet(path, index=False)
+    else:
+        arrays = {}
+        dtypes = []
+        for i, column in enumerate(df.columns):
+            values = np.asarray(df[column])
+            if values.dtype == object:
+                """ Object arrays would need pickle, strings are stored as fixed-width unicode. """
+                values = values.astype(str)
+            arrays['c{0}'.format(i)] = values
+            dtypes.append(values.dtype.str)
+        schema = {'columns': [str(item) for item in df.columns], 'dtypes': dtypes, 'meta': meta}
+        """ np.savez adds the extension if it is missing, a file object keeps the name as given. """
+        with open(path, 'wb') as f:
+            np.savez(f, __schema__=np.array(json.dumps(schema, default=str)), **arrays)
+
+
+def read_table(path, **kwargs):
+    """ Read a table written by write_table (or any csv file) into a pandas DataFrame.
+        Keyword arguments are passed to pandas.read_csv for csv files.
+    """
+    form = table_format(path)
+    if form == '.csv':
+        df = pd.read_csv(path, **kwargs)
+        if df.shape[1] and (df.columns[0] == '' or str(df.columns[0]).startswith('Unnamed: 0')):
+            df = df.drop(columns=df.columns[0])
+        for column in TIME_COLUMNS:
+            if column in df.columns and not pd.api.types.is_datetime64_any_dtype(df[column]):
+                """ Times with a UTC designator ('Z') are converted to naive UTC times like the others. """
+                time = pd.to_datetime(df[column], errors='coerce', utc=True)
+                df[column] = time.dt.tz_localize(None).astype('datetime64[ns]')
+        return df
+    if form == '.parquet':
+        return pd.read_parquet(path)
+    with np.load(path, allow_pickle=False) as archive:
+        schema = json.loads(str(archive['__schema__']))
+        df = pd.DataFrame({name: archive['c{0}'.format(i)] for i, name in enumerate(schema['columns'])})
+    df.attrs.update(schema['meta'])
+    return df
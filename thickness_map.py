@@ -0,0 +1,174 @@
+""" Sea ice thickness field map: gridding of drift-corrected point measurements into a Layer.
+    Points are projected to metres with an equirectangular projection around the survey centre.
+    Three gridding methods are available:
+        'mean'      average of the points within every cell (binned averaging);
+        'nearest'   value of the nearest point within the search radius from the cell centre;
+        'idw'       inverse distance weighted average of the points within the search radius.
+    Neighbour search uses a grid-bucket spatial index, so the cost grows with the number of points
+    and cells rather than with their product.
+"""
+import argparse
+import sys
+
+import numpy as np
+
+from gps_drift import from_local_xy, to_local_xy
+from layer import Layer
+from spatial_index import GridIndex
+from survey_io import read_table
+
+
+def grid_thickness(df, resolution, method='mean', radius=None, power=2, value_column='ice_and_snow',
+                   lat_column='lat_corr', lon_column='lon_corr', origin=None):
+    """ Create a Layer with a thickness map from point measurements.
+        *df* is expected to be a pandas DataFrame with drift-corrected coordinates ('lat_corr', 'lon_corr' by default)
+        and the values ('ice_and_snow' by default).
+        *resolution* is the cell size in metres, *radius* is the search radius for 'nearest' and 'idw' methods
+        (twice the resolution by default), *power* is the power of the inverse distance weights.
+        *origin* (lat, lon) is the projection origin, the mean position of the points by default.
+        Cells without data are NaN. Row 0 of the raster is the northernmost one.
+        Returns a Layer, or False if the input is not valid.
+    """
+    for column in [value_column, lat_column, lon_column]:
+        if column not in df.columns:
+            print('Input pandas DataFrame does not have "{0}" column.'.format(column))
+            return False
+    if method not in ['mean', 'nearest', 'idw']:
+        print('Unknown gridding method {0}, possible values are "mean", "nearest", "idw".'.format(method))
+        return False
+
+    data = df[[lat_column, lon_column, value_column]].dropna()
+    if not data.shape[0]:
+        print('There are no valid points to grid.')
+        return False
+    value = data[value_column].values
+    if origin is None:
+        origin = (data[lat_column].mean(), data[lon_column].mean())
+    x, y = to_local_xy(data[lat_column].values, data[lon_column].values, origin[0], origin[1])
+    if radius is None:
+        radius = 2. * resolution
+
+    """ Raster geometry: (x_min, y_max) is the upper left corner of the raster. """
+    margin = 0. if method == 'mean' else radius
+    x_min = np.floor((x.min() - margin) / resolution) * resolution
+    y_max = np.ceil((y.max() + margin) / resolution) * resolution
+    n_cols = int(np.floor((x.max() + margin - x_min) / resolution)) + 1
+    n_rows = int(np.floor((y_max - y.min() + margin) / resolution)) + 1
+
+    col = np.minimum(((x - x_min) / resolution).astype(np.int64), n_cols - 1)
+    row = np.minimum(((y_max - y) / resolution).astype(np.int64), n_rows - 1)
+    cell = row * n_cols + col
+    if method == 'mean':
+        total = np.bincount(cell, weights=value, minlength=n_rows * n_cols)
+        count = np.bincount(cell, minlength=n_rows * n_cols)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            grid = total / count
+    else:
+        """ Only cells within the search radius from occupied cells can get a value. """
+        occupied = np.zeros(n_rows * n_cols, dtype=bool)
+        occupied[cell] = True
+        cells = np.flatnonzero(_dilate(occupied.reshape(n_rows, n_cols), int(np.ceil(radius / resolution))))
+        qx = x_min + (cells % n_cols + 0.5) * resolution
+        qy = y_max - (cells // n_cols + 0.5) * resolution
+        index = GridIndex(x, y, radius)
+        grid = np.full(n_rows * n_cols, np.nan)
+        if method == 'nearest':
+            nearest, _ = index.nearest(qx, qy, radius)
+            grid[cells] = np.where(nearest >= 0, value[nearest], np.nan)
+        else:
+            query, point, distance = index.query_pairs(qx, qy, radius)
+            weight = 1. / np.maximum(distance, 1e-3 * resolution) ** power
+            total = np.bincount(query, weights=weight * value[point], minlength=qx.size)
+            norm = np.bincount(query, weights=weight, minlength=qx.size)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                grid[cells] = total / norm
+
+    projection = {'name': 'equirectangular', 'lat0': float(origin[0]), 'lon0': float(origin[1]),
+                  'x_min': float(x_min), 'y_max': float(y_max)}
+    timestamp = df['time_corr'].iloc[0] if 'time_corr' in df.columns else None
+    return Layer(grid.reshape(n_rows, n_cols), resolution, projection, timestamp,
+                 desc='{0} gridded with "{1}" method'.format(value_column, method))
+
+
+def add_to_mosaic(mosaic, layer):
+    """ Write a Layer created by grid_thickness into a larger mosaic Layer (in memory or tiled)
+        with the same projection origin and resolution. Only the window covered by the layer is read and written,
+        cells without data in the layer keep the values of the mosaic.
+        Returns False if the layers are not compatible.
+    """
+    for key in ['lat0', 'lon0']:
+        if not np.isclose(mosaic.projection[key], layer.projection[key]):
+            print('Layers have different projection origins.')
+            return False
+    if not np.isclose(mosaic.resolution, layer.resolution):
+        print('Layers have different resolutions.')
+        return False
+    row0 = int(round((mosaic.projection['y_max'] - layer.projection['y_max']) / mosaic.resolution))
+    col0 = int(round((layer.projection['x_min'] - mosaic.projection['x_min']) / mosaic.resolution))
+
+    """ Crop the part of the layer outside of the mosaic. """
+    data = layer.data[max(-row0, 0):, max(-col0, 0):]
+    row0, col0 = max(row0, 0), max(col0, 0)
+    window = np.array(mosaic.read_window(row0, row0 + data.shape[0], col0, col0 + data.shape[1]))
+    data = data[:window.shape[0], :window.shape[1]]
+    mosaic.write_window(row0, col0, np.where(np.isnan(data), window, data))
+    return True
+
+
+def _dilate(mask, k):
+    """ Boolean mask dilated by *k* cells in every direction (box filter with cumulative sums). """
+    if k <= 0:
+        return mask
+    n_rows, n_cols = mask.shape
+    padded = np.zeros((n_rows + 2 * k + 1, n_cols + 2 * k + 1), dtype=np.int64)
+    padded[k + 1:k + 1 + n_rows, k + 1:k + 1 + n_cols] = mask
+    total = padded.cumsum(axis=0).cumsum(axis=1)
+    size = 2 * k + 1
+    box = total[size:, size:] - total[:-size, size:] - total[size:, :-size] + total[:-size, :-size]
+    return box > 0
+
+
+def cell_centers(layer):
+    """ Latitudes and longitudes of the cell centres of a Layer created by grid_thickness (2D arrays). """
+    n_rows, n_cols = layer.data.shape
+    x = layer.projection['x_min'] + (np.arange(n_cols) + 0.5) * layer.resolution
+    y = layer.projection['y_max'] - (np.arange(n_rows) + 0.5) * layer.resolution
+    x, y = np.meshgrid(x, y)
+    return from_local_xy(x, y, layer.projection['lat0'], layer.projection['lon0'])
+
+
+if __name__ == '__main__':
+    desc = """ Create a sea ice thickness map from drift-corrected measurements.
+               Arguments:
+               -i           input file (.npz, .parquet, or .csv) with 'lat_corr', 'lon_corr', and 'ice_and_snow' columns
+               -o           output file (*.npy) for the thickness raster
+               -res         resolution (cell size) in metres
+               -method      gridding method: mean (default), nearest, or idw
+               -radius      search radius in metres for nearest and idw methods (optional)
+           """
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('-i', help='Input file name.')
+    parser.add_argument('-o', help='Output file name.')
+    parser.add_argument('-res', help='Resolution in metres.')
+    parser.add_argument('-method', help='Gridding method: mean, nearest, or idw.')
+    parser.add_argument('-radius', help='Search radius in metres.')
+    args = parser.parse_args()
+
+    """ Check mandatory arguments """
+    if not args.i:
+        print('Input file name should be specified with -i option.')
+        sys.exit()
+    if not args.o:
+        print('Output file name should be specified with -o option.')
+        sys.exit()
+    if not args.res:
+        print('Resolution should be specified with -res option.')
+        sys.exit()
+
+    data = read_table(args.i)
+    layer = grid_thickness(data, float(args.res), args.method or 'mean', float(args.radius) if args.radius else None)
+    if layer is False:
+        print('Something went wrong during the gridding. Check messages above.')
+        sys.exit()
+    np.save(args.o, layer.data)
+    print('Thickness map of {0} x {1} cells is saved to {2}.'.format(layer.data.shape[0], layer.data.shape[1], args.o))
@@ -4,6 +4,8 @@
     In this case the first and the last point of measurements should be the same.
     The drift is assumed to be continious with the constant rate.
     The rotation is neglected.
+    Long surveys that return to the same places several times can be corrected with a drift rate changing
+    between the revisits (correct_segmented_drift), the revisits can be found automatically (find_revisits).
     The second option should be used when only one additional GPS tracked was used
     during the EM survey.
     In this case drift is calculated with the assumption that rotation of the ice flow
@@ -15,9 +17,17 @@
 import argparse
 import sys
 
+import numpy as np
 import pandas as pd
 
+from gps_drift import to_local_xy
+from profiling import DEFAULT_REPORT, enable as enable_profiling, profiled
+from survey_cache import cached_read
+from spatial_index import GridIndex
+from survey_io import read_table, write_table
 
+
+@profiled
 def correct_uniform_drift(df, start_index=0, end_index=None):
     """ Uniform drift correction (without any additional GPS data available).
         Start and end point must be located at the same place of the ice floe.
@@ -51,18 +61,357 @@ def correct_uniform_drift(df, start_index=0, end_index=None):
         print('Input pandas DataFrame does not have "timestamp" column.')
         return False
 
-    lat_start = df.lat[start_index]
-    lon_start = df.lon[start_index]
-    lat_end = df.lat[end_index]
-    lon_end = df.lon[end_index]
-    dt = df.timestamp - df.timestamp[start_index]
+    """ Indices are positions in the DataFrame, not labels of its index. """
+    lat_start = df.lat.iloc[start_index]
+    lon_start = df.lon.iloc[start_index]
+    lat_end = df.lat.iloc[end_index]
+    lon_end = df.lon.iloc[end_index]
+    dt = df.timestamp - df.timestamp.iloc[start_index]
 
-    d_lat = (lat_end - lat_start) / (df.timestamp[end_index] - df.timestamp[start_index])
-    d_lon = (lon_end - lon_start) / (df.timestamp[end_index] - df.timestamp[start_index])
+    d_lat = (lat_end - lat_start) / (df.timestamp.iloc[end_index] - df.timestamp.iloc[start_index])
+    d_lon = (lon_end - lon_start) / (df.timestamp.iloc[end_index] - df.timestamp.iloc[start_index])
 
     df['lat_corr'] = df.lat - d_lat * dt
     df['lon_corr'] = df.lon - d_lon * dt
-    df['time_corr'] = df['time'][start_index]
+    df['time_corr'] = df['time'].iloc[start_index]
+    return True
+
+
+def _natural_spline(x, y, query):
+    """ Natural cubic spline through the points (x, y) evaluated at *query*, *y* may have several columns.
+        Outside of [x[0], x[-1]] the spline is continued linearly.
+    """
+    n = x.size
+    h = np.diff(x)
+    slope = np.diff(y, axis=0) / h[:, None]
+    """ Second derivatives at the knots, zero at the ends. """
+    second = np.zeros_like(y)
+    if n > 2:
+        system = np.diag(2 * (h[:-1] + h[1:])) + np.diag(h[1:-1], 1) + np.diag(h[1:-1], -1)
+        second[1:-1] = np.linalg.solve(system, 6 * np.diff(slope, axis=0))
+    i = np.clip(np.searchsorted(x, query, side='right') - 1, 0, n - 2)
+    t = np.clip(query, x[0], x[-1]) - x[i]
+    hi = h[i][:, None]
+    t = t[:, None]
+    value = (y[i] + t * (slope[i] - hi * (2 * second[i] + second[i + 1]) / 6)
+             + t ** 2 * second[i] / 2 + t ** 3 * (second[i + 1] - second[i]) / (6 * hi))
+    """ Linear continuation with the end slopes. """
+    start_slope = slope[0] - h[0] * (2 * second[0] + second[1]) / 6
+    end_slope = slope[-1] + h[-1] * (second[-2] + 2 * second[-1]) / 6
+    value += np.minimum(query - x[0], 0)[:, None] * start_slope + np.maximum(query - x[-1], 0)[:, None] * end_slope
+    return value
+
+
+def drift_model(seconds, start, end, lat, lon, reference=0., smoothing=1e-6):
+    """ Fit drift of the floe from revisit pairs.
+        *seconds* is an array of times (s), *start* and *end* are arrays of positions of revisit pairs:
+        the points start[k] and end[k] are at the same place of the floe.
+        The drift (lat, lon displacement relative to the *reference* time) is found at the times of all the pairs
+        (knots) with least squares: every pair gives the drift between its two times; the change of the drift rate
+        between consecutive knots is penalized with a small weight (*smoothing*), so knots not constrained
+        by the pairs continue the drift rate smoothly.
+        Returns the knot times and drift values (array of shape (knots, 2): lat and lon, degrees).
+    """
+    start = np.asarray(start)
+    end = np.asarray(end)
+    knots = np.unique(np.concatenate([[reference], seconds[start], seconds[end]]))
+    n = knots.size
+    rows = np.arange(start.size)
+    system = np.zeros((start.size, n))
+    system[rows, np.searchsorted(knots, seconds[end])] += 1
+    system[rows, np.searchsorted(knots, seconds[start])] -= 1
+    target = np.column_stack([lat[end] - lat[start], lon[end] - lon[start]])
+    if n > 2:
+        """ Differences of the drift rate, scaled to the units of the drift. """
+        h = np.diff(knots)
+        penalty = np.zeros((n - 2, n))
+        k = np.arange(n - 2)
+        penalty[k, k] = 1 / h[:-1]
+        penalty[k, k + 1] = -1 / h[:-1] - 1 / h[1:]
+        penalty[k, k + 2] = 1 / h[1:]
+        penalty *= np.median(h) * np.sqrt(smoothing)
+        system = np.vstack([system, penalty])
+        target = np.vstack([target, np.zeros((n - 2, 2))])
+    """ The drift at the reference time is zero. """
+    free = knots != reference
+    drift = np.zeros((n, 2))
+    drift[free] = np.linalg.lstsq(system[:, free], target, rcond=None)[0]
+    return knots, drift
+
+
+def evaluate_drift(knots, drift, query, method='linear'):
+    """ Drift at the times *query* from the knots found with drift_model. """
+    if method == 'spline':
+        return _natural_spline(knots, drift, query)
+    """ Piecewise linear drift, continued with the rates of the first and the last segments. """
+    segment = np.clip(np.searchsorted(knots, query, side='right') - 1, 0, knots.size - 2)
+    rate = (drift[segment + 1] - drift[segment]) / (knots[segment + 1] - knots[segment])[:, None]
+    return drift[segment] + rate * (query - knots[segment])[:, None]
+
+
+@profiled
+def correct_segmented_drift(df, pairs=None, method='linear', transect_column=None, smoothing=1e-6):
+    """ Drift correction with many revisit pairs: piecewise uniform (*method* 'linear') or smooth ('spline') drift.
+        *pairs* is a list of (start, end) positions of rows measured at the same place of the ice floe
+        (positions in the DataFrame, not labels). If not given, the first and the last rows of every transect
+        are used, which is the assumption of correct_uniform_drift.
+        With 'linear' method the drift rate is constant between the times of the pairs, with 'spline' method
+        the drift is a natural cubic spline through the drift values at these times.
+        If *transect_column* is given, every transect (rows with the same value, e.g. concatenated files)
+        is corrected separately to the time of its first row; pairs must not connect different transects.
+        Input pandas DataFrame is expected to have the following columns: 'lat', 'lon', 'time'.
+        This function modifies the dataframe by adding the following columns:
+        'lat_corr', 'lon_corr', 'time_corr' (as in correct_uniform_drift).
+    """
+    if type(df) is not pd.DataFrame:
+        print('Input is expected to be a pandas DataFrame, not {0}'.format(type(df)))
+        return False
+    for column in ['lat', 'lon', 'time'] + ([transect_column] if transect_column else []):
+        if column not in df.columns:
+            print('Input pandas DataFrame does not have "{0}" column.'.format(column))
+            return False
+    if transect_column and df[transect_column].isna().any():
+        print('Transect ids are missing in "{0}" column.'.format(transect_column))
+        return False
+    if method not in ['linear', 'spline']:
+        print('Unknown method {0}, possible values are "linear" and "spline".'.format(method))
+        return False
+
+    n = df.shape[0]
+    time = np.asarray(df.time.values, dtype='datetime64[ns]')
+    lat = df.lat.values.astype(float)
+    lon = df.lon.values.astype(float)
+    if transect_column:
+        transect = pd.factorize(df[transect_column])[0]
+    else:
+        transect = np.zeros(n, dtype=np.int64)
+    n_transects = transect.max() + 1 if n else 0
+
+    if pairs is None:
+        rows = np.arange(n)
+        first = np.full(n_transects, n)
+        last = np.full(n_transects, -1)
+        np.minimum.at(first, transect, rows)
+        np.maximum.at(last, transect, rows)
+        pairs = np.column_stack([first, last])
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    if pairs.size and (pairs.min() < 0 or pairs.max() >= n):
+        print('Pair indices are expected to be between 0 and {0}.'.format(n - 1))
+        return False
+    if np.any(transect[pairs[:, 0]] != transect[pairs[:, 1]]):
+        print('Pairs are expected to connect rows of the same transect.')
+        return False
+
+    seconds = (time - time.min()).astype(np.int64) / 1e9
+    lat_corr = np.full(n, np.nan)
+    lon_corr = np.full(n, np.nan)
+    time_corr = np.empty(n, dtype='datetime64[ns]')
+    """ Rows of every transect, in the order of the transect ids. """
+    order = np.argsort(transect, kind='stable')
+    bounds = np.searchsorted(transect[order], np.arange(n_transects + 1))
+    pair_transect = transect[pairs[:, 0]]
+    for i in range(n_transects):
+        index = order[bounds[i]:bounds[i + 1]]
+        reference = index[np.argmin(time[index])]
+        time_corr[index] = time[reference]
+        selected = pairs[(pair_transect == i) & (seconds[pairs[:, 0]] != seconds[pairs[:, 1]])]
+        if not selected.size:
+            print('Transect {0} has no revisit pairs with different times, it is not corrected.'.format(i))
+            lat_corr[index] = lat[index]
+            lon_corr[index] = lon[index]
+            continue
+        knots, drift = drift_model(seconds, selected[:, 0], selected[:, 1], lat, lon, seconds[reference], smoothing)
+        value = evaluate_drift(knots, drift, seconds[index], method)
+        lat_corr[index] = lat[index] - value[:, 0]
+        lon_corr[index] = lon[index] - value[:, 1]
+
+    df['lat_corr'] = lat_corr
+    df['lon_corr'] = lon_corr
+    df['time_corr'] = time_corr
+    return True
+
+
+""" Minimal change of the direction of the track (degrees) at a turn, and the largest difference of the directions
+    before and after two turns matched as a revisit.
+"""
+TURN_ANGLE = 45.
+HEADING_TOLERANCE = 45.
+
+
+def turn_points(x, y, window, min_angle=TURN_ANGLE):
+    """ Positions of the turns of a track with coordinates *x*, *y* (m): points where the direction of the track
+        changes by more than *min_angle* degrees between the parts *window* metres before and after the point.
+        Every turn is placed at a single point, its apex. Both parts should be displaced by at least half the window,
+        so GPS noise during stops is not taken for turns.
+        Returns the positions and the directions (radians) of the track before and after the turns.
+    """
+    step = np.hypot(np.diff(x), np.diff(y))
+    length = np.concatenate([[0], np.cumsum(np.nan_to_num(step))])
+    rows = np.arange(x.size)
+    before = np.maximum(np.searchsorted(length, length - window, side='right') - 1, 0)
+    after = np.minimum(np.searchsorted(length, length + window, side='left'), x.size - 1)
+    """ GPS noise makes the path longer than the track, the parts are extended until they are *window* long. """
+    for i in range(4):
+        x1, y1 = x - x[before], y - y[before]
+        x2, y2 = x[after] - x, y[after] - y
+        with np.errstate(invalid='ignore', divide='ignore'):
+            scale1 = np.clip(np.nan_to_num(window / np.hypot(x1, y1), nan=1.), 1, 4)
+            scale2 = np.clip(np.nan_to_num(window / np.hypot(x2, y2), nan=1.), 1, 4)
+        before = np.maximum(rows - np.ceil((rows - before) * scale1).astype(np.int64), 0)
+        after = np.minimum(rows + np.ceil((after - rows) * scale2).astype(np.int64), x.size - 1)
+    x1, y1 = x - x[before], y - y[before]
+    x2, y2 = x[after] - x, y[after] - y
+    angle = np.degrees(np.arctan2(np.abs(x1 * y2 - y1 * x2), x1 * x2 + y1 * y2))
+    with np.errstate(invalid='ignore'):
+        turn = ((angle > min_angle) & (np.hypot(x1, y1) >= window / 2) & (np.hypot(x2, y2) >= window / 2))
+    """ Turn points less than a window apart along the track form one turn. The directions are taken at its sharpest
+        point, the turn is placed at its apex: the point farthest in the direction of the turn (the difference
+        of the unit vectors before and after it), which is found more precisely than the largest angle.
+    """
+    rows = np.flatnonzero(turn)
+    if not rows.size:
+        return rows, np.array([]), np.array([])
+    label = np.cumsum(np.concatenate([[True], np.diff(length[rows]) > window])) - 1
+    order = np.lexsort((-angle[rows], label))
+    first = np.concatenate([[True], label[order][1:] != label[order][:-1]])
+    sharpest = rows[order][first]
+    heading_in, heading_out = np.arctan2(y1[sharpest], x1[sharpest]), np.arctan2(y2[sharpest], x2[sharpest])
+    dx = np.cos(heading_in) - np.cos(heading_out)
+    dy = np.sin(heading_in) - np.sin(heading_out)
+    projection = x[rows] * dx[label] + y[rows] * dy[label]
+    order = np.lexsort((-projection, label))
+    first = np.concatenate([[True], label[order][1:] != label[order][:-1]])
+    return rows[order][first], heading_in, heading_out
+
+
+def _turn_pairs(x, y, seconds, group, radius, min_gap, window):
+    """ Pairs of turns of the track (i < j) of the same group within *radius* metres and at least *min_gap* seconds
+        apart and with the same directions of the track before and after them, every turn is paired with the next
+        return to it. Unlike the closest points of two passes along a line, which only repeat the current drift frame,
+        a turn marks the same place of the floe on every pass.
+    """
+    turns, heading_in, heading_out = turn_points(x, y, window)
+    if not turns.size:
+        return np.zeros((0, 2), dtype=np.int64)
+    index = GridIndex(x[turns], y[turns], radius)
+    query, point, _ = index.query_pairs(x[turns], y[turns], radius)
+    tolerance = np.radians(HEADING_TOLERANCE)
+    same = ((np.abs(np.angle(np.exp(1j * (heading_in[query] - heading_in[point])))) < tolerance)
+            & (np.abs(np.angle(np.exp(1j * (heading_out[query] - heading_out[point])))) < tolerance))
+    query, point = turns[query], turns[point]
+    gap = seconds[point] - seconds[query]
+    keep = same & (gap >= min_gap) & (group[point] == group[query])
+    query, point, gap = query[keep], point[keep], gap[keep]
+    order = np.lexsort((gap, query))
+    first = np.concatenate([[True], query[order][1:] != query[order][:-1]]) if query.size else np.array([], bool)
+    return np.column_stack([query[order][first], point[order][first]]).astype(np.int64)
+
+
+def _drift_frame(seconds, lat, lon, group, pairs, smoothing):
+    """ Coordinates with the drift found from *pairs* removed, separately for every group.
+        The first and the last points of every group are used if *pairs* is None.
+    """
+    frame_lat, frame_lon = lat.copy(), lon.copy()
+    for g in range(group.max() + 1):
+        rows = np.flatnonzero(group == g)
+        if pairs is None:
+            selected = np.array([[rows[0], rows[-1]]])
+        else:
+            selected = pairs[group[pairs[:, 0]] == g]
+        selected = selected[seconds[selected[:, 0]] != seconds[selected[:, 1]]]
+        if not selected.size:
+            continue
+        knots, drift = drift_model(seconds, selected[:, 0], selected[:, 1], lat, lon, seconds[rows[0]], smoothing)
+        value = evaluate_drift(knots, drift, seconds[rows])
+        frame_lat[rows] -= value[:, 0]
+        frame_lon[rows] -= value[:, 1]
+    return frame_lat, frame_lon
+
+
+@profiled
+def find_revisits(df, radius=5., min_gap=300., iterations=3, transect_column=None, window=None, smoothing=1.):
+    """ Find revisit pairs: points of the track measured at the same place of the ice floe at different times.
+        Positions are compared in a drift-compensated frame: 'lat_corr', 'lon_corr' if the DataFrame has them
+        (e.g. after correct_rigid_drift), otherwise uniform drift between the first and the last points.
+        Revisits are matched at the turns of the track (see turn_points, the direction is compared over *window*
+        metres, 2 * *radius* by default): along a line the closest points of two passes can slide along it, and their
+        crossings move with the error of the frame, while a turn is at the same place of the floe on every pass.
+        Turns within the search radius are paired with a spatial index (GridIndex), the drift frame is
+        refitted from the pairs (drift_model) and the search is repeated with the radius decreasing
+        from 2 * *radius* to *radius* over *iterations* passes.
+        The frame only has to be accurate to the search radius, it is fitted with a stiff drift model (*smoothing*),
+        which does not follow the errors of single pairs. Pairs that are farther apart than the radius
+        in the final frame are dropped.
+        *min_gap* (seconds) separates revisits from the points of the same turn.
+        Only the turns are indexed, so the search time grows linearly with the number of points.
+        Returns an array of (start, end) positions (rows of the DataFrame), sorted by start,
+        or False if the input is not valid.
+    """
+    if type(df) is not pd.DataFrame:
+        print('Input is expected to be a pandas DataFrame, not {0}'.format(type(df)))
+        return False
+    for column in ['lat', 'lon', 'time'] + ([transect_column] if transect_column else []):
+        if column not in df.columns:
+            print('Input pandas DataFrame does not have "{0}" column.'.format(column))
+            return False
+    if transect_column and df[transect_column].isna().any():
+        print('Transect ids are missing in "{0}" column.'.format(transect_column))
+        return False
+
+    time = np.asarray(df.time.values, dtype='datetime64[ns]')
+    seconds = (time - time.min()).astype(np.int64) / 1e9
+    lat = df.lat.values.astype(float)
+    lon = df.lon.values.astype(float)
+    group = pd.factorize(df[transect_column])[0] if transect_column else np.zeros(lat.size, dtype=np.int64)
+    lat0, lon0 = np.nanmean(lat), np.nanmean(lon)
+    if 'lat_corr' in df.columns and 'lon_corr' in df.columns:
+        frame_lat, frame_lon = df.lat_corr.values.astype(float), df.lon_corr.values.astype(float)
+    else:
+        frame_lat, frame_lon = _drift_frame(seconds, lat, lon, group, None, smoothing)
+
+    pairs = np.zeros((0, 2), dtype=np.int64)
+    for i in range(iterations):
+        if pairs.size:
+            frame_lat, frame_lon = _drift_frame(seconds, lat, lon, group, pairs, smoothing)
+        x, y = to_local_xy(frame_lat, frame_lon, lat0, lon0)
+        search = radius * 2 ** (1 - i / max(iterations - 1, 1)) if iterations > 1 else radius
+        pairs = _turn_pairs(x, y, seconds, group, search, min_gap, window or 2 * radius)
+    if pairs.size:
+        frame_lat, frame_lon = _drift_frame(seconds, lat, lon, group, pairs, smoothing)
+        x, y = to_local_xy(frame_lat, frame_lon, lat0, lon0)
+        pairs = pairs[np.hypot(x[pairs[:, 1]] - x[pairs[:, 0]], y[pairs[:, 1]] - y[pairs[:, 0]]) <= radius]
+    return pairs[np.argsort(pairs[:, 0], kind='stable')]
+
+
+def correct_rigid_drift(df, floe, time_corr=None):
+    """ Drift correction with GPS trackers on the ice floe (movement and rotation).
+        *floe* is a drift_station.IceFloe with reference point series (at least the zero point; with one tracker
+        only the movement is corrected).
+        Input pandas DataFrame is expected to have the following columns: 'lat', 'lon', 'time'.
+        This function modifies the dataframe by adding the following columns:
+        'x', 'y' with floe-fixed coordinates (metres), and 'lat_corr', 'lon_corr', 'time_corr' with positions
+        of the measurements at time_corr (the time of the first measurement by default).
+    """
+    if type(df) is not pd.DataFrame:
+        print('Input is expected to be a pandas DataFrame, not {0}'.format(type(df)))
+        return False
+    for column in ['lat', 'lon', 'time']:
+        if column not in df.columns:
+            print('Input pandas DataFrame does not have "{0}" column.'.format(column))
+            return False
+
+    local = floe.global2local(df.lat.values, df.lon.values, df.time.values)
+    if local is False:
+        return False
+    if time_corr is None:
+        time_corr = df.time.values[0]
+    corrected = floe.local2global(local[0], local[1], np.full(df.shape[0], np.datetime64(time_corr, 'ns')))
+    if corrected is False:
+        return False
+
+    df['x'], df['y'] = local
+    df['lat_corr'], df['lon_corr'] = corrected
+    df['time_corr'] = time_corr
     return True
 
 
@@ -71,12 +420,23 @@ if __name__ == '__main__':
               Choose two points of the track, where location on an ice floe is the same.
               Based on these points the drift rate is estimated assuming its uniform.
               Arguments:
-                -i input    data file
-                -o output   data file (optional)
+                -i input    data file (.npz, .parquet, or .csv)
+                -o output   data file (optional), the format is given by the extension
                 -savefig    path to the figure with the result (optional)
                 -showfig    if specified the figure with the result is shown
                 -start      id of the starting point, default is 0
                 -end        id of the end point, default is the last point of the track
+                -pairs      revisit pairs for the segmented correction, e.g. 0:1500,1500:3200 (optional)
+                -method     drift between the pairs for the segmented correction: linear (default) or spline
+                -smoothing  weight of the drift rate changes for the segmented correction, default is 1e-6,
+                            larger values give smoother drift if the pairs are noisy
+                -transect   column with transect ids, every transect is corrected separately (optional),
+                            the first and the last points of every transect are used if -pairs is not given
+                -auto       find revisit pairs automatically and apply the segmented correction
+                -radius     search radius for -auto (m), default is 5
+                -min_gap    minimal time between the points of a revisit pair for -auto (s), default is 300
+                -cache      directory for cached parsed files (optional)
+                -profile    save profiling report to a json file (optional), default is em31_profile.json
            """
     parser = argparse.ArgumentParser(description=desc)
     parser.add_argument('-i', help='input data file')
@@ -85,7 +445,18 @@ if __name__ == '__main__':
     parser.add_argument('-showfig', help='show figure of the result')
     parser.add_argument('-start', help='id of the starting point, default is 0')
     parser.add_argument('-end', help='id of the end point, default is the last point in the data')
+    parser.add_argument('-pairs', help='revisit pairs start:end separated by commas')
+    parser.add_argument('-method', help='linear or spline')
+    parser.add_argument('-smoothing', help='weight of the drift rate changes, default is 1e-6')
+    parser.add_argument('-transect', help='column with transect ids')
+    parser.add_argument('-auto', action='store_true', help='find revisit pairs automatically')
+    parser.add_argument('-radius', help='search radius for revisit pairs (m), default is 5')
+    parser.add_argument('-min_gap', help='minimal time between the points of a revisit pair (s), default is 300')
+    parser.add_argument('-cache', help='directory for cached parsed files (optional)')
+    parser.add_argument('-profile', nargs='?', const=DEFAULT_REPORT, help='save profiling report to a json file (optional)')
     args = parser.parse_args()
+    if args.profile:
+        enable_profiling(args.profile)
 
     """ Check mandatory arguments """
     if not args.i:
@@ -93,17 +464,31 @@ if __name__ == '__main__':
         sys.exit()
     
     """ Set optional arguments """
-    if not args.start:
-        args.start = 0
-    if not args.end:
-        args.end = None
+    args.start = int(args.start) if args.start else 0
+    args.end = int(args.end) if args.end else None
+    args.radius = float(args.radius) if args.radius else 5.
+    args.min_gap = float(args.min_gap) if args.min_gap else 300.
+    args.smoothing = float(args.smoothing) if args.smoothing else 1e-6
 
     try:
-        data = pd.read_csv(args.i)
+        if args.cache:
+            data = cached_read(read_table, args.i, cache_dir=args.cache)
+        else:
+            data = read_table(args.i)
     except:
-        print('Input is expected to be a *.csv file. Could not read the input file.')
+        print('Input is expected to be a *.npz, *.parquet, or *.csv file. Could not read the input file.')
         sys.exit()
-    ret = correct_uniform_drift(data, start_index=args.start, end_index=args.end)
+    if args.auto:
+        pairs = find_revisits(data, args.radius, args.min_gap, transect_column=args.transect)
+        if pairs is not False:
+            print('{0} revisit pairs found.'.format(len(pairs)))
+        ret = pairs is not False and correct_segmented_drift(data, pairs, args.method or 'linear', args.transect,
+                                                             args.smoothing)
+    elif args.pairs or args.transect:
+        pairs = [[int(index) for index in item.split(':')] for item in args.pairs.split(',')] if args.pairs else None
+        ret = correct_segmented_drift(data, pairs, args.method or 'linear', args.transect, args.smoothing)
+    else:
+        ret = correct_uniform_drift(data, start_index=args.start, end_index=args.end)
     if not ret:
         print('Something went wrong during the correction. Check messages above.')
         sys.exit()
@@ -112,7 +497,7 @@ if __name__ == '__main__':
         print('Output file is not specified, results are not saved.')
         print('To save result specify output file with -o option')
     else:
-        data.to_csv(args.o)
+        write_table(data, args.o)
     if not args.showfig and not args.savefig:
         sys.exit()
 